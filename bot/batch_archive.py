@@ -0,0 +1,328 @@
+"""Offline re-summarization of archived history through OpenAI's Batch API.
+
+Rebuilds the archived summaries of many chats at once, e.g. after ARCHIVING_PROMPT or
+MERGING_PROMPT changed, at batch pricing and without using the live traffic's rate
+limits. It runs in two phases:
+
+1. chunks: one request per message bucket, summarizing it like a live archive would.
+   Each result is stored on its bucket as `summary`.
+2. merges: the chunk summaries older than the newest MAX_CHUNK_SUMMARIES are folded
+   into a new top-level summary in rounds, each merging as many chunks as fit into
+   CHUNK_INPUT_TOKENS, so no chunk is cut off however many buckets a chat has.
+
+A rebuilt top-level summary starts from the summary of the history before the chat's
+first live bucket, which the live archiver records on that bucket as `prior_summary`
+(empty for a new or erased chat, the old summary for a chat summarized before buckets
+existed). Chats whose first bucket predates that field are rebuilt only partly: their
+current top-level summary is kept, since it covers exactly the buckets older than the
+newest MAX_CHUNK_SUMMARIES and can't be separated from the history before them, and
+only the newest chunk summaries are rebuilt. Every phase is split into as many
+batches as the Batch API's per-file limits require, submitted together.
+
+The new summaries are then written to the head documents in bulk, but only for chats
+whose version and bucket_seq didn't change since they were read, so live archives and
+erases that happened while the batches ran are never overwritten. Chats whose live
+buckets aren't contiguous up to bucket_seq are skipped.
+
+Usage:
+    python batch_archive.py [--chat-id ID ...] [--limit N] [--batch-size N]
+                            [--poll-interval S] [--base-url URL] [--dry-run]
+
+--base-url points the command at another API, e.g. a local stub server for testing.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+from openai import AsyncOpenAI
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+from db import (
+    conversations, message_buckets, split_summaries, summary_messages, complete_summary,
+    ARCHIVING_PROMPT, MERGING_PROMPT, CHUNK_INPUT_TOKENS, CHUNK_SUMMARY_TOKENS, MAX_CHUNK_SUMMARIES,
+    TOP_SUMMARY_TOKENS
+)
+from prompt import estimate_tokens, truncate_to_tokens
+from routing import choose_model
+
+
+ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# Batch statuses after which nothing changes anymore
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Limits of one batch input file (50,000 requests, 200 MB), with headroom on the size
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 100 * 1024 * 1024
+
+
+def summary_request(custom_id, route, system_prompt, content, max_tokens):
+    """One line of the batch input file, the same request summarize() would send."""
+    messages = summary_messages(system_prompt, content, max_tokens)
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": {"model": choose_model(route, messages), "messages": messages, "max_tokens": max_tokens}
+    }
+
+
+def transcript(messages):
+    return "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
+
+
+async def load_chats(chat_ids=None, limit=0):
+    """Read the chats to re-archive with their live buckets, oldest bucket first."""
+    query = {"bucket_seq": {"$gt": 0}}
+    if chat_ids:
+        query["chat_id"] = {"$in": chat_ids}
+
+    chats = []
+    cursor = conversations.find(
+        query, {"_id": 0, "chat_id": 1, "version": 1, "bucket_seq": 1, "archived_messages": 1}, limit=limit
+    )
+    async for conversation in cursor:
+        chat_id = conversation['chat_id']
+        buckets = await message_buckets.find(
+            {"chat_id": chat_id, "erased_at": {"$exists": False}},
+            {"_id": 0, "seq": 1, "messages": 1, "prior_summary": 1}
+        ).sort("seq", ASCENDING).to_list(None)
+
+        seqs = [bucket['seq'] for bucket in buckets]
+        if not seqs or seqs != list(range(seqs[0], conversation['bucket_seq'])):
+            logging.warning(f"Skipping chat_id: {chat_id}, its buckets don't cover the archived history")
+            continue
+        top_summary, _ = split_summaries(conversation.pop('archived_messages', None))
+        prior_summary = buckets[0].get('prior_summary')
+        if prior_summary is None:
+            # Only the chunks that sit next to the kept top-level summary are rebuilt
+            buckets = buckets[-MAX_CHUNK_SUMMARIES:]
+        chats.append(dict(conversation, buckets=buckets, top_summary=top_summary, prior_summary=prior_summary))
+    return chats
+
+
+def merge_round(chunks):
+    """Split off the oldest chunks that fit into one merge next to the top-level summary."""
+    budget = CHUNK_INPUT_TOKENS - TOP_SUMMARY_TOKENS
+    taken = []
+    used = 0
+    for chunk in chunks:
+        chunk = truncate_to_tokens(chunk, CHUNK_SUMMARY_TOKENS)
+        if taken and used + estimate_tokens(chunk) > budget:
+            break
+        taken.append(chunk)
+        used += estimate_tokens(chunk)
+    return taken, chunks[len(taken):]
+
+
+async def fold_chunks(client, top_summaries, older_chunks, poll_interval):
+    """Fold each chat's older chunks into its top-level summary, oldest first, one batch per round.
+
+    top_summaries and older_chunks are keyed by chat_id. Returns the new top-level
+    summaries of the chats whose merges all succeeded.
+    """
+    top_summaries = dict(top_summaries)
+    pending = {chat_id: chunks for chat_id, chunks in older_chunks.items() if chunks}
+    merge_round_number = 0
+    while pending:
+        requests = []
+        remaining = {}
+        for chat_id, chunks in pending.items():
+            taken, remaining[chat_id] = merge_round(chunks)
+            requests.append(summary_request(
+                str(chat_id), 'merge', MERGING_PROMPT,
+                "Long-term memory:\n" + truncate_to_tokens(top_summaries[chat_id], TOP_SUMMARY_TOKENS) +
+                "\n\nNext part:\n" + "\n\n".join(taken),
+                TOP_SUMMARY_TOKENS
+            ))
+        merged = await run_batches(client, requests, f"merges-{merge_round_number}", poll_interval)
+        merge_round_number += 1
+
+        for chat_id in list(pending):
+            if str(chat_id) not in merged:
+                logging.warning(f"Skipping chat_id: {chat_id}, its top-level summary wasn't merged")
+                del pending[chat_id]
+                del top_summaries[chat_id]
+                continue
+            top_summaries[chat_id] = merged[str(chat_id)]
+            if remaining[chat_id]:
+                pending[chat_id] = remaining[chat_id]
+            else:
+                del pending[chat_id]
+    return top_summaries
+
+
+def split_batches(lines):
+    """Split encoded request lines into input files within MAX_BATCH_REQUESTS and MAX_BATCH_BYTES."""
+    files = []
+    current, size = [], 0
+    for line in lines:
+        if current and (len(current) >= MAX_BATCH_REQUESTS or size + len(line) + 1 > MAX_BATCH_BYTES):
+            files.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        files.append(current)
+    return files
+
+
+async def run_batches(client, requests, description, poll_interval):
+    """Submit the requests in as many batches as needed, wait for all and return {custom_id: reply text}."""
+    lines = [json.dumps(request, ensure_ascii=False).encode() for request in requests]
+    parts = split_batches(lines)
+    results = {}
+    for part in await asyncio.gather(*[
+        run_batch(client, part, f"{description}-{index}" if len(parts) > 1 else description, poll_interval)
+        for index, part in enumerate(parts)
+    ]):
+        results.update(part)
+    return results
+
+
+async def run_batch(client, lines, description, poll_interval):
+    """Submit encoded request lines as one batch, wait for it and return {custom_id: reply text}."""
+    payload = b"\n".join(lines)
+    input_file = await client.files.create(file=(f"{description}.jsonl", payload), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=ENDPOINT,
+        completion_window=COMPLETION_WINDOW,
+        metadata={"description": description}
+    )
+    logging.info(f"Submitted batch {batch.id} with {len(lines)} {description} requests")
+
+    while batch.status not in FINAL_STATUSES:
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        logging.info(f"Batch {batch.id} is {batch.status}" + (f" ({counts.completed}/{counts.total} done)" if counts else ""))
+
+    if batch.status != "completed" or not batch.output_file_id:
+        # An expired batch still returns the requests that did finish
+        logging.error(f"Batch {batch.id} ended as {batch.status}")
+        if not batch.output_file_id:
+            return {}
+
+    results = {}
+    output = await client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get('response') or {}
+        if result.get('error') or response.get('status_code') != 200:
+            logging.error(f"Request {result.get('custom_id')} of batch {batch.id} failed: {result.get('error') or response}")
+            continue
+        choice = response['body']['choices'][0]
+        results[result['custom_id']] = complete_summary(choice['message']['content'], choice.get('finish_reason'))
+    return results
+
+
+async def store_chunk_summaries(chats, chunk_summaries, batch_size):
+    """Save every chunk summary on its bucket, in bulk."""
+    requests = [
+        UpdateOne({"chat_id": chat['chat_id'], "seq": bucket['seq']}, {"$set": {"summary": summary}})
+        for chat in chats
+        for bucket in chat['buckets']
+        if (summary := chunk_summaries.get(f"{chat['chat_id']}:{bucket['seq']}")) is not None
+    ]
+    for start in range(0, len(requests), batch_size):
+        await message_buckets.bulk_write(requests[start:start + batch_size], ordered=False)
+
+
+async def write_summaries(chats, summaries, batch_size):
+    """Replace the archived summaries of the chats that didn't change meanwhile. Returns how many did."""
+    requests = [
+        UpdateOne(
+            {"chat_id": chat['chat_id'], "version": chat.get('version'), "bucket_seq": chat['bucket_seq']},
+            {"$set": {"archived_messages": summaries[chat['chat_id']]}, "$inc": {"version": 1}}
+        )
+        for chat in chats
+        if chat['chat_id'] in summaries
+    ]
+    modified = 0
+    for start in range(0, len(requests), batch_size):
+        result = await conversations.bulk_write(requests[start:start + batch_size], ordered=False)
+        modified += result.modified_count
+    if modified < len(requests):
+        logging.warning(f"{len(requests) - modified} chats changed while their batches ran and were left as they are")
+    return modified
+
+
+async def rearchive(client, chat_ids=None, limit=0, batch_size=100, poll_interval=60, dry_run=False):
+    """Re-summarize the archived history of the selected chats through the Batch API."""
+    chats = await load_chats(chat_ids, limit)
+    chunk_requests = [
+        summary_request(
+            f"{chat['chat_id']}:{bucket['seq']}", 'archive', ARCHIVING_PROMPT,
+            truncate_to_tokens(transcript(bucket['messages']), CHUNK_INPUT_TOKENS),
+            CHUNK_SUMMARY_TOKENS
+        )
+        for chat in chats
+        for bucket in chat['buckets']
+    ]
+    if dry_run:
+        partial = sum(chat['prior_summary'] is None for chat in chats)
+        logging.info(f"Would re-archive {len(chats)} chats ({partial} only partly) with {len(chunk_requests)} chunk requests")
+        return 0
+    if not chunk_requests:
+        logging.info("Nothing to re-archive")
+        return 0
+
+    chunk_summaries = await run_batches(client, chunk_requests, "chunks", poll_interval)
+    await store_chunk_summaries(chats, chunk_summaries, batch_size)
+
+    # Only chats with every chunk summarized can be rebuilt
+    newest_chunks = {}
+    carried = {}
+    older_chunks = {}
+    for chat in chats:
+        chunks = [chunk_summaries.get(f"{chat['chat_id']}:{bucket['seq']}") for bucket in chat['buckets']]
+        if None in chunks:
+            logging.warning(f"Skipping chat_id: {chat['chat_id']}, some of its chunks weren't summarized")
+            continue
+        newest_chunks[chat['chat_id']] = chunks[-MAX_CHUNK_SUMMARIES:]
+        if chat['prior_summary'] is None:
+            # Partly rebuilt: the current top-level summary stays as it is
+            carried[chat['chat_id']] = chat['top_summary']
+            older_chunks[chat['chat_id']] = []
+        else:
+            carried[chat['chat_id']] = chat['prior_summary']
+            older_chunks[chat['chat_id']] = chunks[:-MAX_CHUNK_SUMMARIES]
+
+    top_summaries = await fold_chunks(client, carried, older_chunks, poll_interval)
+    summaries = {
+        chat_id: [top_summaries[chat_id]] + newest
+        for chat_id, newest in newest_chunks.items()
+        if chat_id in top_summaries
+    }
+
+    modified = await write_summaries(chats, summaries, batch_size)
+    logging.info(f"Re-archived {modified} of {len(chats)} chats")
+    return modified
+
+
+async def run(args):
+    client = AsyncOpenAI(api_key=os.getenv('COFOUNDERAI_GPT_API_KEY'), base_url=args.base_url)
+    try:
+        await rearchive(
+            client, chat_ids=args.chat_id, limit=args.limit, batch_size=args.batch_size,
+            poll_interval=args.poll_interval, dry_run=args.dry_run
+        )
+    except PyMongoError as e:
+        logging.error(f"Re-archiving failed: {str(e)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chat-id', type=int, action='append', help="only re-archive this chat (repeatable)")
+    parser.add_argument('--limit', type=int, default=0, help="re-archive at most this many chats")
+    parser.add_argument('--batch-size', type=int, default=100, help="updates per bulk write")
+    parser.add_argument('--poll-interval', type=float, default=60, help="seconds between batch status checks")
+    parser.add_argument('--base-url', help="OpenAI API base URL, e.g. of a local stub server")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be submitted")
+
+    raise SystemExit(asyncio.run(run(parser.parse_args())))
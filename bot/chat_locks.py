@@ -0,0 +1,20 @@
+"""Per-chat locks for work that has to run one at a time and in order within a chat."""
+import asyncio
+import weakref
+
+
+class ChatLocks:
+    """One asyncio.Lock per chat with work in flight; asyncio.Lock wakes waiters in FIFO order.
+
+    A chat's lock is only referenced while someone holds or waits for it, so chats that
+    went quiet don't accumulate.
+    """
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+
+    def get(self, chat_id):
+        lock = self.locks.get(chat_id)
+        if lock is None:
+            lock = self.locks[chat_id] = asyncio.Lock()
+        return lock
@@ -0,0 +1,96 @@
+"""Opt-in cache of chat completions for repeated or near-identical prompts.
+
+The key is a hash of the model, the system prompt and the (already budget-trimmed)
+conversation with every message normalized: case, whitespace and trailing punctuation
+don't matter. In practice hits come from conversations that just started, where many
+users open with the same introductions and questions. Entries live in an in-process
+LRU for the warm container and in the completion_cache collection (expired by a TTL
+index) across containers. Enable with COFOUNDERAI_COMPLETION_CACHE=1.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+import db
+import metrics
+
+
+ENABLED = os.getenv('COFOUNDERAI_COMPLETION_CACHE', '0') == '1'
+TTL = int(os.getenv('COFOUNDERAI_COMPLETION_CACHE_TTL', 24 * 3600))
+MAX_ENTRIES = int(os.getenv('COFOUNDERAI_COMPLETION_CACHE_SIZE', 256))
+
+# key -> (expires_at, reply, tokens); most recently used last
+entries = OrderedDict()
+
+
+def normalize(text):
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    return re.sub(r'\s+', ' ', text).strip().lower().rstrip('.!?,;: ')
+
+
+def cache_key(model, messages):
+    """Key for a prompt: model, hash of the system prompt, normalized conversation."""
+    system_prompt, conversation = messages[0], messages[1:]
+    system_hash = hashlib.sha256(system_prompt['content'].encode()).hexdigest()
+    normalized = [[message['role'], normalize(message['content'])] for message in conversation]
+    payload = json.dumps([model, system_hash, normalized], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def get(model, messages):
+    """Return the cached reply for the prompt, or None."""
+    if not ENABLED:
+        return None
+    key = cache_key(model, messages)
+
+    entry = entries.get(key)
+    if entry is not None:
+        expires_at, reply, tokens = entry
+        if expires_at > time.time():
+            entries.move_to_end(key)
+            record_hit('completion_cache_hits_memory', tokens)
+            return reply
+        del entries[key]
+
+    cached = await db.get_cached_completion(key)
+    if cached is not None:
+        remember(key, cached['reply'], cached['expires_at'], cached.get('tokens'))
+        record_hit('completion_cache_hits_mongo', cached.get('tokens'))
+        return cached['reply']
+
+    metrics.incr('completion_cache_misses')
+    return None
+
+
+async def put(model, messages, reply, usage=None):
+    """Cache a reply generated for the prompt."""
+    if not ENABLED or not reply:
+        return
+    key = cache_key(model, messages)
+    expires_at = time.time() + TTL
+    tokens = usage.total_tokens if usage is not None else None
+    remember(key, reply, expires_at, tokens)
+    await db.save_cached_completion(key, reply, expires_at, tokens)
+
+
+def remember(key, reply, expires_at, tokens=None):
+    entries[key] = (expires_at, reply, tokens)
+    entries.move_to_end(key)
+    while len(entries) > MAX_ENTRIES:
+        entries.popitem(last=False)
+
+
+def record_hit(counter, tokens):
+    metrics.incr(counter)
+    if tokens:
+        # Together with the openai_seconds average this gives the saved spend and latency
+        metrics.incr('completion_cache_saved_tokens', tokens)
+
+
+def hit_rate():
+    """Share of lookups answered from the cache since the container started."""
+    hits = metrics.counters.get('completion_cache_hits_memory', 0) + metrics.counters.get('completion_cache_hits_mongo', 0)
+    lookups = hits + metrics.counters.get('completion_cache_misses', 0)
+    return hits / lookups if lookups else 0.0
@@ -1,148 +1,826 @@
-from pymongo import MongoClient, UpdateOne, ssl_support
-from pymongo.errors import PyMongoError
+from pymongo import UpdateOne, ReturnDocument, ASCENDING
+from pymongo.errors import PyMongoError, DuplicateKeyError
 import openai
 import os
 import asyncio
-from openai import AsyncOpenAI 
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import logging
 from motor.motor_asyncio import AsyncIOMotorClient
+from mongo_transfer import track, event_listeners, window_budget, TRANSFER_BUDGETS
+from llm import create_completion
+from openai_client import get_client
+from prompt import truncate_to_tokens
+from routing import choose_model
+import metrics
 
 
 
 # Configure logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-openai_client = AsyncOpenAI(api_key=os.getenv('COFOUNDERAI_GPT_API_KEY'))
-
-# Initialize MongoDB client
+# Initialize MongoDB client. Motor keeps Mongo I/O off the event loop, so the handlers
+# can overlap it with OpenAI and Telegram calls of concurrent updates.
 MONGO_URI = os.getenv('COFOUNDERAI_MONGO_URI')
-mongo_client = MongoClient(
+mongo_client = AsyncIOMotorClient(
     MONGO_URI,
     tls=True,
-    tlsAllowInvalidCertificates=True
+    tlsAllowInvalidCertificates=True,
+    event_listeners=event_listeners()
 )
 db = mongo_client.ChatHistory  
+# Per-chat head documents: the live message window and the archived summaries.
+# Anything that leaves the live window goes to its own documents so the head stays small.
 conversations = db.conversations  # Assume a collection named 'conversations'
+message_buckets = db.message_buckets  # Raw messages that were summarized, one document per archived batch
+erased_conversations = db.erased_conversations  # One snapshot document per /erase
+summary_jobs = db.summary_jobs  # Pending summarizations, at most one per chat
+completion_cache = db.completion_cache  # Cached completions keyed by prompt hash, expired by TTL index
+bot_identities = db.bot_identities  # Cached getMe snapshots, keyed by bot_id
+update_queue = db.update_queue  # Raw Telegram updates acknowledged in ingest mode, waiting for the worker
+processed_updates = db.processed_updates  # update_ids being or already processed, expired by TTL index
+chat_leases = db.chat_leases  # Which container is processing an update of a chat right now
 
 current_utc_time = datetime.now(timezone.utc)
 
+# How long a container may hold a summary job before another one can take it over; a
+# bucket older than that whose seq the head hasn't moved past was orphaned
+SUMMARY_JOB_LEASE = timedelta(minutes=5)
+# How long a worker may hold a queued update, and how often an update is tried before it's given up
+UPDATE_LEASE = timedelta(minutes=5)
+MAX_UPDATE_ATTEMPTS = 3
+# How long an update_id is remembered, well beyond Telegram's redelivery attempts, and how
+# long an in-flight update is left to its container (Lambda's maximum timeout) before another takes it over
+PROCESSED_UPDATE_TTL = timedelta(days=1)
+PROCESSING_LEASE = timedelta(minutes=15)
+
+# Indexes each collection needs, as (keys, options) per collection name. ensure_indexes()
+# creates whatever is missing, so adding an entry here is all a new query pattern needs.
+INDEXES = {
+    "conversations": [
+        ([("chat_id", ASCENDING)], {"name": "chat_id_unique", "unique": True}),
+    ],
+    "message_buckets": [
+        ([("chat_id", ASCENDING), ("seq", ASCENDING)], {"name": "chat_id_seq_unique", "unique": True}),
+    ],
+    "erased_conversations": [
+        ([("chat_id", ASCENDING), ("erased_at", ASCENDING)], {"name": "chat_id_erased_at_unique", "unique": True}),
+    ],
+    "summary_jobs": [
+        ([("chat_id", ASCENDING)], {"name": "chat_id_unique", "unique": True}),
+        ([("status", ASCENDING), ("lease_until", ASCENDING)], {"name": "status_lease_until"}),
+    ],
+    "completion_cache": [
+        ([("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ],
+    "bot_identities": [
+        ([("bot_id", ASCENDING)], {"name": "bot_id_unique", "unique": True}),
+    ],
+    "update_queue": [
+        ([("update_id", ASCENDING)], {"name": "update_id_unique", "unique": True}),
+        ([("status", ASCENDING), ("lease_until", ASCENDING), ("enqueued_at", ASCENDING)], {"name": "status_lease_until_enqueued_at"}),
+    ],
+    "processed_updates": [
+        ([("update_id", ASCENDING)], {"name": "update_id_unique", "unique": True}),
+        ([("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ],
+    "chat_leases": [
+        ([("chat_id", ASCENDING)], {"name": "chat_id_unique", "unique": True}),
+    ],
+}
+
+# Messages are summarized and archived in batches of this size
+ARCHIVE_BATCH_SIZE = 25
+# Token caps of the incremental summaries: one chunk summary per archived batch (of at
+# most CHUNK_INPUT_TOKENS of transcript), up to MAX_CHUNK_SUMMARIES of them, and the
+# top-level summary the oldest chunks are merged into
+CHUNK_INPUT_TOKENS = 4000
+CHUNK_SUMMARY_TOKENS = 300
+MAX_CHUNK_SUMMARIES = 4
+TOP_SUMMARY_TOKENS = 600
+# Most recent messages sent along with the archived summaries in the prompt
+HISTORY_WINDOW = int(os.getenv('COFOUNDERAI_HISTORY_WINDOW', 2 * ARCHIVE_BATCH_SIZE))
+
+TRANSFER_BUDGETS.update({
+    "append_and_get_history": window_budget(HISTORY_WINDOW),
+    "get_conversation_history": window_budget(HISTORY_WINDOW),
+    "summarize_and_archive_messages": window_budget(ARCHIVE_BATCH_SIZE),
+    # The live window is returned as it was before the erase, which may not be archived yet
+    "erase_history": window_budget(2 * HISTORY_WINDOW),
+})
 
-def save_message(chat_id, role, content):
-    """Save a message to the database."""
+
+@track('save_message')
+async def save_message(chat_id, role, content, message_id=None, reply_to=None):
+    """Save a message to the database.
+
+    message_id (the Telegram message id of a user message) or reply_to (the id of the
+    message an assistant response answers) make the save idempotent: saving the same
+    message again is a no-op.
+    """
     try:
-        conversations.update_one(
-            {"chat_id": chat_id},
-            {"$push": {"messages": {
-                "role": role, 
-                "content": content, 
-                "timestamp": datetime.now(timezone.utc).isoformat()  # Convert datetime to ISO format string
-            }}},
-            upsert=True
-        )
+        await push_message(chat_id, new_message(role, content, message_id, reply_to), message_id, reply_to)
     except PyMongoError as e:
         logging.error(f"MongoDB error: {str(e)}")
 
 
-def get_conversation_history(chat_id):
+def new_message(role, content, message_id=None, reply_to=None):
+    message = {
+        "role": role,
+        "content": content,
+        "timestamp": datetime.now(timezone.utc).isoformat()  # Convert datetime to ISO format string
+    }
+    if message_id is not None:
+        message['message_id'] = message_id
+    if reply_to is not None:
+        message['reply_to'] = reply_to
+    return message
+
+
+def identifies(message_id=None, reply_to=None):
+    """Filter condition on a conversation's messages that identifies the message, or None."""
+    if message_id is not None:
+        return "messages.message_id", message_id
+    if reply_to is not None:
+        return "messages.reply_to", reply_to
+    return None
+
+
+async def push_message(chat_id, message, message_id=None, reply_to=None, projection=None):
+    """Append a message to the chat's conversation unless it's stored already.
+
+    Returns the conversation after the push (or the one that already had the message),
+    limited to projection. Doesn't rely on the unique chat_id index, which may not exist
+    yet: an identified message is pushed into an existing conversation that doesn't have
+    it, and a conversation is only upserted (on chat_id alone) if there was none.
+    """
+    projection = projection or {"_id": 1}
+    push = {"$push": {"messages": message}}
+    identity = identifies(message_id, reply_to)
+    if identity is not None:
+        field, value = identity
+        conversation = await conversations.find_one_and_update(
+            {"chat_id": chat_id, field: {"$ne": value}}, push,
+            projection=projection, return_document=ReturnDocument.AFTER
+        )
+        if conversation is not None:
+            return conversation
+        # Either the chat has no conversation yet or it has the message already
+        conversation = await conversations.find_one({"chat_id": chat_id, field: value}, projection)
+        if conversation is not None:
+            logging.info(f"Message already saved for chat_id: {chat_id}")
+            return conversation
+
+    try:
+        return await conversations.find_one_and_update(
+            {"chat_id": chat_id}, push,
+            projection=projection, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # A concurrent first message created the conversation meanwhile; append to it
+        return await conversations.find_one_and_update(
+            {"chat_id": chat_id}, push,
+            projection=projection, return_document=ReturnDocument.AFTER
+        )
+
+
+def format_history(conversation):
+    """Turn a conversation document into chat completion messages, archived summaries first."""
+    # Combine messages and archived_messages
+    history = []
+    if 'archived_messages' in conversation and conversation['archived_messages']:
+        # Adding archived messages as system messages for context (the top-level summary
+        # is empty until the first chunk summaries have been merged into it)
+        for archive in conversation['archived_messages']:
+            if archive:
+                history.append({"role": "system", "content": archive})
+
+    if 'messages' in conversation and conversation['messages']:
+        history.extend([{"role": msg['role'], "content": msg['content']} for msg in conversation['messages']])
+
+    return history
+
+
+@track('get_conversation_history')
+async def get_conversation_history(chat_id):
     """Retrieve the conversation history for a given chat, including archived messages."""
     try:
-        conversation = conversations.find_one({"chat_id": chat_id}, {"_id": 0, "messages": 1, "archived_messages": 1})
+        conversation = await conversations.find_one(
+            {"chat_id": chat_id},
+            {"_id": 0, "messages": {"$slice": -HISTORY_WINDOW}, "archived_messages": 1}
+        )
         if not conversation:
             return []
+        return format_history(conversation)
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return []  # Return an empty list in case of error
 
-        # Combine messages and archived_messages
-        history = []
-        if 'archived_messages' in conversation and conversation['archived_messages']:
-            # Adding archived messages as system messages for context
-            for archive in conversation['archived_messages']:
-                history.append({"role": "system", "content": archive})
 
-        if 'messages' in conversation and conversation['messages']:
-            history.extend([{"role": msg['role'], "content": msg['content']} for msg in conversation['messages']])
-        
-        return history
+@track('append_and_get_history')
+async def append_and_get_history(chat_id, role, content, message_id=None):
+    """Save a message and return the history for the prompt plus the stored message count.
+
+    Pushes the message and reads back the archived summaries and the last HISTORY_WINDOW
+    messages (including the new one) in a single round trip. With a message_id, a
+    message that is already stored (e.g. a redelivered update) isn't pushed again.
+    """
+    projection = {
+        "_id": 0,
+        "archived_messages": 1,
+        "messages": {"$slice": -HISTORY_WINDOW},
+        "message_count": {"$size": "$messages"}
+    }
+    try:
+        conversation = await push_message(
+            chat_id, new_message(role, content, message_id), message_id, projection=projection
+        )
+        return format_history(conversation), conversation['message_count']
     except PyMongoError as e:
         logging.error(f"MongoDB error: {str(e)}")
-        return []  # Return an empty list in case of error
+        return [{"role": role, "content": content}], None
+
+
+ARCHIVING_PROMPT = (
+    "You are an archiving bot tasked with condensing, and archiving conversation history.\n\n"
+
+    "Please make sure to compactly pack as much contextual info as possible into your allowed maximum character length:\n"
+    "- Use bullet points\n"
+    "- Use dictionaries or any other efficient archival system\n"
+
+    "Your goal is for your counterparty AI bot to later reference the 'memory' you create in order to always be up-to-date on all the prior context of the whole conversation.\n\n"
+
+    "The conversation will be predominantly based around business and ventures so please help your AI bot pal in retaining this memory.\n\n"
+
+    "Most importantly, make sure you do NOT continue the conversation but only perform the archival action."
+)
+
+MERGING_PROMPT = (
+    ARCHIVING_PROMPT + "\n\n"
+    "You will receive the long-term memory of the conversation followed by the memory of its next part. "
+    "Merge them into a single updated long-term memory, keeping what still matters and dropping what has been superseded."
+)
+
+
+# Words asked for per token of a summary's max_tokens, leaving headroom below the hard cap
+WORDS_PER_SUMMARY_TOKEN = 0.6
+
+
+def summary_messages(system_prompt, content, max_tokens):
+    """The messages of a summary request, with the length limit stated in the system prompt."""
+    limit = f"\n\nKeep the memory under {int(max_tokens * WORDS_PER_SUMMARY_TOKEN)} words and end on a complete bullet point."
+    return [{"role": "system", "content": system_prompt + limit}, {"role": "user", "content": content}]
+
+
+def complete_summary(content, finish_reason):
+    """Drop the unfinished last line of a summary that was cut off at max_tokens."""
+    if finish_reason != 'length':
+        return content
+    metrics.incr('summaries_cut_off')
+    logging.warning("Summary hit its token cap, dropping its unfinished last line")
+    return content.rsplit("\n", 1)[0] if "\n" in content else content
 
 
+async def summarize(chat_id, route, system_prompt, content, max_tokens):
+    """Ask OpenAI for a summary of at most max_tokens tokens, using the route's model."""
+    messages = summary_messages(system_prompt, content, max_tokens)
+    response = await create_completion(
+        get_client(), chat_id, route,
+        model=choose_model(route, messages),
+        messages=messages,
+        max_tokens=max_tokens
+    )
+    choice = response.choices[0]
+    return complete_summary(choice.message.content, choice.finish_reason)
 
 
-async def summarize_and_archive_messages(chat_id):
-    """Retrieve, summarize, and archive old messages asynchronously using OpenAI."""
-    conversation = conversations.find_one({"chat_id": chat_id})
-    if conversation and len(conversation['messages']) > 25:
-        # Retrieve messages to be summarized and any existing summary.
-        messages_to_summarize = conversation['messages'][:25]
-        existing_summary = conversation['archived_messages'][0] if 'archived_messages' in conversation and conversation['archived_messages'] else ""
+def split_summaries(archived_messages):
+    """Split archived_messages into the top-level summary and the rolling chunk summaries.
 
-        # Combine existing summary with new messages for a comprehensive summary.
-        context = existing_summary + "\n" + "\n".join([msg['content'] for msg in messages_to_summarize])
+    archived_messages[0] is the top-level summary (empty until the first fold), the rest
+    are chunk summaries, oldest first. A single entry is a summary from before chunking
+    existed and becomes the top-level summary.
+    """
+    archived_messages = archived_messages or []
+    if len(archived_messages) <= 1:
+        return (archived_messages[0] if archived_messages else ""), []
+    return archived_messages[0], list(archived_messages[1:])
 
-        messages_formatted = [{"role": "system", "content": (
-                        "You are an archiving bot tasked with condensing, and archiving conversation history.\n\n"
-                        
-                        "Please make sure to compactly pack as much contextual info as possible into your allowed maximum character length:\n"
-                        "- Use bullet points\n"
-                        "- Use dictionaries or any other efficient archival system\n"
-                        
-                        "Your goal is for your counterparty AI bot to later reference the 'memory' you create in order to always be up-to-date on all the prior context of the whole conversation.\n\n"
-                        
-                        "The conversation will be predominantly based around business and ventures so please help your AI bot pal in retaining this memory.\n\n"
-                        
-                        "Most importantly, make sure you do NOT continue the conversation but only perform the archival action."
-                                )}] + \
-                             [{"role": "user", "content": context}]
+
+@track('summarize_and_archive_messages')
+async def summarize_and_archive_messages(chat_id, message_count=None):
+    """Retrieve, summarize, and archive old messages asynchronously using OpenAI.
+
+    Summaries are kept incrementally: every archived batch gets its own chunk summary of
+    at most CHUNK_SUMMARY_TOKENS, and once there are more than MAX_CHUNK_SUMMARIES the
+    oldest one is merged into the top-level summary of at most TOP_SUMMARY_TOKENS. Each
+    step only sees bounded input, so a batch costs the same however old the chat is.
+
+    When the caller already knows how many messages are stored, the read is skipped
+    unless there is something to archive.
+    """
+    if message_count is not None and message_count <= ARCHIVE_BATCH_SIZE:
+        return
+
+    # Only the batch to be summarized is read; messages saved meanwhile are never rewritten
+    conversation = await conversations.find_one(
+        {"chat_id": chat_id},
+        {
+            "_id": 0,
+            "messages": {"$slice": [0, ARCHIVE_BATCH_SIZE]},
+            "message_count": {"$size": {"$ifNull": ["$messages", []]}},
+            "archived_messages": 1,
+            "bucket_seq": 1,
+            "version": 1
+        }
+    )
+    if conversation and conversation['message_count'] > ARCHIVE_BATCH_SIZE:
+        # Retrieve messages to be summarized and the existing summaries.
+        messages_to_summarize = conversation['messages']
+        top_summary, chunk_summaries = split_summaries(conversation.get('archived_messages'))
+        # The first bucket since the chat started (or was erased, or last summarized before
+        # buckets existed) records the summary of everything before it, for batch_archive.py
+        prior_summary = top_summary if not chunk_summaries else None
+
+        transcript = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages_to_summarize])
 
         try:
-            # Asynchronous call to OpenAI's API for summarization
-            response = await openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages_formatted
-            )
-            updated_summary = response.choices[0].message.content
-
-            # Ensure there is only one archived entry and it's updated, not added to
-            conversations.update_one(
-                {"chat_id": chat_id},
-                {
-                    "$set": {
-                        "archived_messages": [updated_summary],
-                        "messages": conversation['messages'][25:]  # retain only the unsummarized messages
-                    }
-                }
-            )
+            # Asynchronous calls to OpenAI's API for summarization
+            chunk_summaries.append(await summarize(
+                chat_id, 'archive', ARCHIVING_PROMPT,
+                truncate_to_tokens(transcript, CHUNK_INPUT_TOKENS),
+                CHUNK_SUMMARY_TOKENS
+            ))
+            if len(chunk_summaries) > MAX_CHUNK_SUMMARIES:
+                oldest_chunk = chunk_summaries.pop(0)
+                top_summary = await summarize(
+                    chat_id, 'merge', MERGING_PROMPT,
+                    "Long-term memory:\n" + truncate_to_tokens(top_summary, TOP_SUMMARY_TOKENS) +
+                    "\n\nNext part:\n" + truncate_to_tokens(oldest_chunk, CHUNK_SUMMARY_TOKENS),
+                    TOP_SUMMARY_TOKENS
+                )
         except Exception as e:
             logging.error(f"OpenAI API error: {str(e)}")
+            return
+
+        await archive_batch(chat_id, conversation.get('version'), conversation.get('bucket_seq', 0),
+                            messages_to_summarize, [top_summary] + chunk_summaries, prior_summary)
+
+
+async def archive_batch(chat_id, version, bucket_seq, messages_to_archive, summaries, prior_summary=None):
+    """Atomically replace the summaries and drop the archived batch from the live window.
+
+    The head document's version changes on every archive and erase, so the update only
+    applies if nothing else archived or erased the chat since the batch was read. The
+    batch is removed positionally on the server, so messages appended in the meantime
+    are kept. Returns True if the batch was archived.
+    """
+    bucket = {
+        "chat_id": chat_id,
+        "seq": bucket_seq,
+        "messages": messages_to_archive,
+        "first_at": messages_to_archive[0].get('timestamp'),
+        "last_at": messages_to_archive[-1].get('timestamp'),
+        "archived_at": datetime.now(timezone.utc).isoformat()
+    }
+    if prior_summary is not None:
+        bucket['prior_summary'] = prior_summary
+    try:
+        # Keep the summarized raw messages in their own bucket document. The unique
+        # (chat_id, seq) index also stops a concurrent archiver of the same batch.
+        # A copy, since insert_one adds the _id a replacement mustn't carry
+        bucket_id = (await message_buckets.insert_one(dict(bucket))).inserted_id
+    except DuplicateKeyError:
+        bucket_id = await replace_orphaned_bucket(chat_id, bucket_seq, bucket)
+        if bucket_id is None:
+            logging.info(f"Batch {bucket_seq} of chat_id: {chat_id} is already being archived")
+            return False
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return False
+
+    batch_size = len(messages_to_archive)
+    try:
+        update_result = await conversations.update_one(
+            {"chat_id": chat_id, "version": version},
+            [{"$set": {
+                "archived_messages": {"$literal": summaries},
+                # retain only the unsummarized messages, including any saved during summarization
+                "messages": {"$slice": ["$messages", batch_size, {"$max": [1, {"$subtract": [{"$size": "$messages"}, batch_size]}]}]},
+                "bucket_seq": bucket_seq + 1,
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+            }}]
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        update_result = None
+
+    if update_result is None or update_result.modified_count == 0:
+        logging.info(f"Conversation of chat_id: {chat_id} changed during summarization, discarding the summary")
+        await message_buckets.delete_one({"_id": bucket_id})
+        return False
+    return True
 
 
-def erase_history(chat_id):
+async def replace_orphaned_bucket(chat_id, bucket_seq, bucket):
+    """Take over a bucket left behind by an archiver that never updated the head document.
+
+    An archiver that is cancelled (e.g. by the deadline), frozen or killed between
+    inserting its bucket and updating the head leaves the bucket behind, and its seq
+    would block every later archive of the chat. A bucket whose seq the head still
+    hasn't moved past and that is older than SUMMARY_JOB_LEASE belongs to no live
+    archiver, so it's replaced. Returns the bucket's _id, or None if it isn't orphaned.
+    """
+    stale_before = (datetime.now(timezone.utc) - SUMMARY_JOB_LEASE).isoformat()
+    try:
+        head = await conversations.find_one({"chat_id": chat_id}, {"_id": 0, "bucket_seq": 1})
+        if head is None or head.get('bucket_seq', 0) != bucket_seq:
+            return None
+        replaced = await message_buckets.find_one_and_replace(
+            {"chat_id": chat_id, "seq": bucket_seq, "archived_at": {"$lt": stale_before}},
+            bucket,
+            projection={"_id": 1}
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return None
+    if replaced is None:
+        return None
+    metrics.incr('orphaned_buckets_replaced')
+    logging.warning(f"Replaced orphaned bucket {bucket_seq} of chat_id: {chat_id}")
+    return replaced['_id']
+
+
+@track('erase_history')
+async def erase_history(chat_id):
     """Erase the chat history by moving all messages to an erased history archive."""
     try:
-        # Fetch the current state of the conversation
-        conversation = conversations.find_one({"chat_id": chat_id})
-        # Prepare the content to be moved to the erased messages array
-        if conversation:
-            existing_messages = conversation.get('messages', [])
-            existing_archived = conversation.get('archived_messages', [])
+        # Clear the conversation and get what was cleared in one atomic step, so messages
+        # saved concurrently are either erased or kept, never lost. Bumping the version
+        # makes a summarization that is running right now discard its result.
+        conversation = await conversations.find_one_and_update(
+            {"chat_id": chat_id},
+            {
+                "$set": {"messages": [], "archived_messages": []},
+                "$inc": {"version": 1}
+            },
+            projection={"_id": 0, "messages": 1, "archived_messages": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        # Move the cleared content to the erased conversations collection
+        if conversation and (conversation.get('messages') or conversation.get('archived_messages')):
+            erased_at = datetime.now(timezone.utc).isoformat()
             # Compile all current messages and archives into a single entry
-            all_content = {
-                "archived_at": datetime.now(timezone.utc).isoformat(),
-                "messages": existing_messages,
-                "archived_messages": existing_archived
-            }
-            # Update the conversation document
-            update_result = conversations.update_one(
-                {"chat_id": chat_id},
-                {
-                    "$push": {"erased_messages": all_content},
-                    "$set": {"messages": [], "archived_messages": []}
-                }
+            await erased_conversations.insert_one({
+                "chat_id": chat_id,
+                "erased_at": erased_at,
+                "messages": conversation.get('messages', []),
+                "archived_messages": conversation.get('archived_messages', [])
+            })
+            # Buckets of the erased history are kept but no longer belong to the live chat
+            await message_buckets.update_many(
+                {"chat_id": chat_id, "erased_at": {"$exists": False}},
+                {"$set": {"erased_at": erased_at}}
+            )
+            logging.info("Successfully erased history for chat_id: {}".format(chat_id))
+        else:
+            logging.info("No changes made to the database for chat_id: {}".format(chat_id))
+    except PyMongoError as e:
+        logging.error("Failed to erase history for chat_id: {}. Error: {}".format(chat_id, str(e)))
+
+
+@track('get_bot_identity')
+async def get_bot_identity(bot_id):
+    """Retrieve the cached getMe snapshot of the bot, if one was stored."""
+    try:
+        identity = await bot_identities.find_one({"bot_id": bot_id}, {"_id": 0, "user": 1})
+        return identity['user'] if identity else None
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return None
+
+
+@track('save_bot_identity')
+async def save_bot_identity(bot_id, user):
+    """Store the getMe snapshot of the bot so later cold starts can skip the call."""
+    try:
+        await bot_identities.update_one(
+            {"bot_id": bot_id},
+            {"$set": {"user": user, "updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+
+@track('enqueue_summary_job')
+async def enqueue_summary_job(chat_id):
+    """Record that a chat needs summarizing. Enqueuing an already pending chat is a no-op."""
+    try:
+        await summary_jobs.update_one(
+            {"chat_id": chat_id},
+            {"$setOnInsert": {
+                "chat_id": chat_id,
+                "status": "pending",
+                "enqueued_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another container enqueued the same chat at the same time
+        return True
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return False
+
+
+@track('claim_summary_job')
+async def claim_summary_job(chat_id):
+    """Take the lease on a chat's summary job. Returns False if there is none or it's leased."""
+    now = datetime.now(timezone.utc)
+    try:
+        job = await summary_jobs.find_one_and_update(
+            {"chat_id": chat_id, "$or": [{"status": "pending"}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "lease_until": now + SUMMARY_JOB_LEASE}},
+            projection={"_id": 1}
+        )
+        return job is not None
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return False
+
+
+@track('complete_summary_job')
+async def complete_summary_job(chat_id):
+    """Remove a finished summary job."""
+    try:
+        await summary_jobs.delete_one({"chat_id": chat_id, "status": "running"})
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+@track('find_summary_jobs')
+async def find_summary_jobs(limit=10):
+    """Return chat_ids of jobs that are pending or whose lease expired (e.g. the container froze)."""
+    now = datetime.now(timezone.utc)
+    try:
+        cursor = summary_jobs.find(
+            {"$or": [{"status": "pending"}, {"lease_until": {"$lt": now}}]},
+            {"_id": 0, "chat_id": 1}
+        ).limit(limit)
+        return [job['chat_id'] async for job in cursor]
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return []
+
+
+@track('enqueue_update')
+async def enqueue_update(update_id, update):
+    """Queue a raw update for the worker. Returns False if it was queued before (a redelivery)."""
+    try:
+        await update_queue.insert_one({
+            "update_id": update_id,
+            "update": update,
+            "status": "queued",
+            "attempts": 0,
+            "enqueued_at": datetime.now(timezone.utc)
+        })
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+@track('claim_update')
+async def claim_update():
+    """Lease the oldest queued update (or one whose worker's lease expired). Returns it or None."""
+    now = datetime.now(timezone.utc)
+    try:
+        return await update_queue.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "processing", "lease_until": {"$lt": now}}]},
+            {"$set": {"status": "processing", "lease_until": now + UPDATE_LEASE}, "$inc": {"attempts": 1}},
+            projection={"_id": 0, "update_id": 1, "update": 1, "attempts": 1},
+            sort=[("enqueued_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return None
+
+
+@track('complete_update')
+async def complete_update(update_id):
+    """Remove a processed update from the queue."""
+    try:
+        await update_queue.delete_one({"update_id": update_id})
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+@track('release_update')
+async def release_update(update_id, attempts):
+    """Put back an update whose processing failed, or park it as failed after MAX_UPDATE_ATTEMPTS."""
+    status = "failed" if attempts >= MAX_UPDATE_ATTEMPTS else "queued"
+    try:
+        await update_queue.update_one(
+            {"update_id": update_id, "status": "processing"},
+            {"$set": {"status": status}, "$unset": {"lease_until": ""}}
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+@track('requeue_update')
+async def requeue_update(update_id):
+    """Put back a claimed update that wasn't processed (e.g. out of time), without counting the attempt."""
+    try:
+        await update_queue.update_one(
+            {"update_id": update_id, "status": "processing"},
+            {"$set": {"status": "queued"}, "$unset": {"lease_until": ""}, "$inc": {"attempts": -1}}
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+@track('claim_processed_update')
+async def claim_processed_update(update_id):
+    """Record that the update is being processed. Returns False if it's processed or in flight elsewhere.
+
+    Fails open: if Mongo can't be asked, the update is processed rather than dropped.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        try:
+            await processed_updates.insert_one({
+                "update_id": update_id,
+                "status": "in_flight",
+                "lease_until": now + PROCESSING_LEASE,
+                "expires_at": now + PROCESSED_UPDATE_TTL
+            })
+            return True
+        except DuplicateKeyError:
+            # Taken over only if the container that was processing it is gone
+            result = await processed_updates.update_one(
+                {"update_id": update_id, "status": "in_flight", "lease_until": {"$lt": now}},
+                {"$set": {"lease_until": now + PROCESSING_LEASE}}
             )
-            if update_result.modified_count == 0:
-                logging.info("No changes made to the database for chat_id: {}".format(chat_id))
-            else:
-                logging.info("Successfully erased history for chat_id: {}".format(chat_id))
+            return result.modified_count == 1
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return True
+
+
+@track('finish_processed_update')
+async def finish_processed_update(update_id):
+    """Mark the update as processed."""
+    try:
+        await processed_updates.update_one(
+            {"update_id": update_id},
+            {"$set": {"status": "done"}, "$unset": {"lease_until": ""}}
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+@track('release_processed_update')
+async def release_processed_update(update_id):
+    """Forget an update whose processing failed, so a redelivery processes it again."""
+    try:
+        await processed_updates.delete_one({"update_id": update_id, "status": "in_flight"})
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+@track('acquire_chat_lease')
+async def acquire_chat_lease(chat_id, owner, duration):
+    """Take the chat's lease for duration (a timedelta) unless another owner holds it. Returns True if taken.
+
+    Fails open: if Mongo can't be asked, the update is processed without the lease.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        await chat_leases.update_one(
+            {"chat_id": chat_id, "$or": [{"lease_until": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "lease_until": now + duration}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The lease exists and is held by someone else, so the upsert collided with it
+        return False
     except PyMongoError as e:
-        logging.error("Failed to erase history for chat_id: {}. Error: {}".format(chat_id, str(e)))
\ No newline at end of file
+        logging.error(f"MongoDB error: {str(e)}")
+        return True
+
+
+@track('release_chat_lease')
+async def release_chat_lease(chat_id, owner):
+    """Give up the chat's lease if we still hold it."""
+    try:
+        await chat_leases.delete_one({"chat_id": chat_id, "owner": owner})
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+@track('get_cached_completion')
+async def get_cached_completion(key):
+    """Return the cached completion for a prompt key (reply, expires_at epoch seconds, tokens)."""
+    try:
+        cached = await completion_cache.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "reply": 1, "expires_at": 1, "tokens": 1}
+        )
+        if cached is None:
+            return None
+        # The client returns naive datetimes, which Mongo stores in UTC
+        cached['expires_at'] = cached['expires_at'].replace(tzinfo=timezone.utc).timestamp()
+        return cached
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+        return None
+
+
+@track('save_cached_completion')
+async def save_cached_completion(key, reply, expires_at, tokens=None):
+    """Store a completion for a prompt key until expires_at (epoch seconds)."""
+    try:
+        await completion_cache.update_one(
+            {"_id": key},
+            {"$set": {
+                "reply": reply,
+                "tokens": tokens,
+                "expires_at": datetime.fromtimestamp(expires_at, timezone.utc)
+            }},
+            upsert=True
+        )
+    except PyMongoError as e:
+        logging.error(f"MongoDB error: {str(e)}")
+
+
+class MissingIndexes(RuntimeError):
+    pass
+
+
+def declared_indexes(unique_only=False):
+    """(collection, keys, options) of every declared index, or only of the unique ones."""
+    return [
+        (collection_name, keys, options)
+        for collection_name, indexes in INDEXES.items()
+        for keys, options in indexes
+        if options.get('unique') or not unique_only
+    ]
+
+
+async def missing_indexes(unique_only=False):
+    """Return (collection, index name) for every declared index that doesn't exist yet."""
+    declared = declared_indexes(unique_only)
+    collection_names = list(dict.fromkeys(collection_name for collection_name, _, _ in declared))
+    existing = dict(zip(collection_names, await asyncio.gather(*[
+        db[collection_name].index_information() for collection_name in collection_names
+    ])))
+    return [
+        (collection_name, options['name'])
+        for collection_name, keys, options in declared
+        if keys not in [info['key'] for info in existing[collection_name].values()]
+    ]
+
+
+async def create_indexes(missing):
+    """Create the given (collection, index name) declared indexes. Returns the ones created."""
+    created = []
+    for collection_name, keys, options in declared_indexes():
+        if (collection_name, options['name']) not in missing:
+            continue
+        try:
+            await db[collection_name].create_index(keys, **options)
+            created.append((collection_name, options['name']))
+            logging.info(f"Created index {options['name']} on {collection_name}")
+        except PyMongoError as e:
+            # e.g. duplicate chat_ids that have to be cleaned up before a unique index can be built
+            logging.error(f"Failed to create index {options['name']} on {collection_name}: {str(e)}")
+    return created
+
+
+async def ensure_indexes():
+    """Create the declared indexes that are missing. Safe to run on every cold start."""
+    try:
+        missing = await missing_indexes()
+    except PyMongoError as e:
+        logging.error(f"MongoDB error while listing indexes: {str(e)}")
+        return []
+    return await create_indexes(missing)
+
+
+async def require_unique_indexes(create=True):
+    """Make sure every declared unique index exists, creating the missing ones unless create is False.
+
+    Idempotent saves, update deduplication, chat leases, the archiver's batch guard and
+    the update queue are only correct with their unique indexes, so nothing may be
+    processed without them. Raises MissingIndexes (or the PyMongoError of the check).
+    """
+    missing = await missing_indexes(unique_only=True)
+    if missing and create:
+        created = await create_indexes(missing)
+        missing = [index for index in missing if index not in created]
+    if missing:
+        raise MissingIndexes(f"Missing unique indexes: {', '.join(f'{name} on {collection}' for collection, name in missing)}")
@@ -0,0 +1,66 @@
+"""Per-invocation deadline derived from the Lambda context.
+
+main() calls start(context) for every invocation; anything running on behalf of that
+invocation can then ask how much time is left before Lambda kills the function. The
+deadline bounds every outgoing call: OpenAI requests get a per-request timeout (see
+llm.py), Mongo operations run under pymongo.timeout() (see mongo_timeout()) and Telegram
+requests get their read timeout capped (see telegram_bot.py). handle_message runs the
+reply under run_before() so that a fallback message still fits in before the deadline.
+"""
+import asyncio
+import contextvars
+import os
+import time
+import pymongo
+
+
+# Time kept in reserve for wrapping up (logging, returning the response) before Lambda's timeout
+SAFETY_MARGIN = float(os.getenv('COFOUNDERAI_DEADLINE_MARGIN', 2.0))
+# Time kept in reserve, on top of the margin, for telling the user the reply didn't make it
+FALLBACK_RESERVE = float(os.getenv('COFOUNDERAI_DEADLINE_FALLBACK_RESERVE', 3.0))
+# Shortest timeout handed to a call, so one started right at the deadline fails fast instead of not at all
+MIN_TIMEOUT = 0.1
+
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+def start(context):
+    """Set the deadline of the current invocation from the Lambda context, if there is one."""
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        current_deadline.set(None)
+        return None
+    deadline = time.monotonic() + get_remaining() / 1000 - SAFETY_MARGIN
+    current_deadline.set(deadline)
+    return deadline
+
+
+def remaining():
+    """Seconds left until the deadline, or None when there is no deadline."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def bound(timeout):
+    """The timeout capped to the time left, or unchanged when there is no deadline."""
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, MIN_TIMEOUT)
+    return left if timeout is None else min(timeout, left)
+
+
+def mongo_timeout():
+    """pymongo.timeout() for the rest of the invocation; no limit when there is no deadline."""
+    left = remaining()
+    return pymongo.timeout(None if left is None else max(left, MIN_TIMEOUT))
+
+
+async def run_before(coro, reserve=0):
+    """Await coro, cancelling it reserve seconds before the deadline with asyncio.TimeoutError."""
+    left = remaining()
+    if left is None:
+        return await coro
+    return await asyncio.wait_for(coro, max(left - reserve, 0))
@@ -0,0 +1,198 @@
+"""Chat completion calls with retries scoped to the call itself.
+
+Only the request to OpenAI is retried, never the handler around it, so nothing that was
+already stored or sent happens twice. Waits honour the server's Retry-After and
+x-ratelimit-reset-* headers, otherwise they back off exponentially with full jitter,
+and no retry is started that couldn't finish before the invocation's deadline. Every
+attempt goes through the shared admission controller in ratelimit.py and gets its
+timeouts capped to the time left in the invocation.
+
+With COFOUNDERAI_OPENAI_HEDGE_PERCENTILE set (e.g. 95), a non-streaming attempt that is
+still running after that percentile of the model's recent latencies is hedged: a second,
+identical request is sent and whichever answers first wins. This trades a few percent
+more tokens for a much shorter tail.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from collections import defaultdict, deque
+import httpx
+import openai
+import deadline
+import metrics
+import openai_client
+from prompt import estimate_prompt_tokens
+from ratelimit import admission
+import routing
+
+
+MAX_TRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+# Completion tokens reserved with the rate limiter when the call sets no max_tokens
+EXPECTED_COMPLETION_TOKENS = 500
+
+HEDGE_PERCENTILE = float(os.getenv('COFOUNDERAI_OPENAI_HEDGE_PERCENTILE', 0))
+# Latencies kept per model for the percentile, and how many are needed before hedging starts
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+# model -> recent latencies of successful non-streaming requests, in seconds
+latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+DURATION_PART_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def is_retryable(exc):
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUS_CODES or exc.status_code >= 500
+    return False
+
+
+def parse_duration(value):
+    """Parse OpenAI's reset durations such as '20ms', '1s' or '6m0s' into seconds."""
+    parts = DURATION_PART_PATTERN.findall(value or '')
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def server_delay(headers, rate_limited=False):
+    """How long the server asked us to wait, in seconds, or None if it didn't say."""
+    if headers is None:
+        return None
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    if not rate_limited:
+        return None
+    # The limit that ran out resets last; the other one has room left
+    resets = [parse_duration(headers.get(name)) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def retry_delay(exc, attempt):
+    """Seconds to wait before the next attempt."""
+    response = getattr(exc, 'response', None)
+    delay = server_delay(response.headers if response is not None else None, isinstance(exc, openai.RateLimitError))
+    if delay is not None:
+        # A little jitter so callers told the same reset time don't return in lockstep
+        return min(delay, MAX_DELAY) + random.uniform(0, BASE_DELAY / 4)
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def request_timeout():
+    """The client's timeouts capped to the time left in the invocation, or None without a deadline."""
+    if deadline.remaining() is None:
+        return None
+    return httpx.Timeout(
+        connect=deadline.bound(openai_client.CONNECT_TIMEOUT),
+        read=deadline.bound(openai_client.READ_TIMEOUT),
+        write=deadline.bound(openai_client.WRITE_TIMEOUT),
+        pool=deadline.bound(openai_client.POOL_TIMEOUT)
+    )
+
+
+def hedge_delay(model):
+    """Seconds after which a request to the model is hedged, or None if it shouldn't be."""
+    samples = latencies[model]
+    if not HEDGE_PERCENTILE or len(samples) < MIN_LATENCY_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * HEDGE_PERCENTILE / 100), len(ordered) - 1)]
+
+
+async def send(client, chat_id, tokens, kwargs):
+    """One admitted request, with its timeouts bounded by the deadline. Returns the raw response."""
+    await admission.acquire(chat_id, tokens)
+    start = time.monotonic()
+    timeout = request_timeout()
+    if timeout is not None:
+        kwargs = dict(kwargs, timeout=timeout)
+    raw_response = await client.chat.completions.with_raw_response.create(**kwargs)
+    elapsed = time.monotonic() - start
+    metrics.observe('openai_seconds', elapsed)
+    admission.update_from_headers(raw_response.headers)
+    if not kwargs.get('stream'):
+        latencies[kwargs.get('model')].append(elapsed)
+    return raw_response
+
+
+async def send_hedged(client, chat_id, tokens, kwargs):
+    """send(), plus a second identical request if the first is slower than the hedge percentile."""
+    delay = None if kwargs.get('stream') else hedge_delay(kwargs.get('model'))
+    if delay is None:
+        return await send(client, chat_id, tokens, kwargs)
+
+    first = asyncio.ensure_future(send(client, chat_id, tokens, kwargs))
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        remaining = deadline.remaining()
+        if done or (remaining is not None and remaining <= delay):
+            return await first
+
+        metrics.incr('openai_hedges')
+        second = asyncio.ensure_future(send(client, chat_id, tokens, kwargs))
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        metrics.incr('openai_hedge_wins')
+                    return task.result()
+        # Both failed; the original request's error decides about retrying
+        raise first.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def create_completion(client, chat_id=None, route=None, **kwargs):
+    """client.chat.completions.create(**kwargs), retrying transient failures of this call only.
+
+    Every attempt first waits for admission by the shared rate limiter, which is fed
+    the rate limit headers of every response. chat_id is used to queue chats fairly,
+    route (see routing.py) to report latency and usage per route.
+    """
+    tokens = estimate_prompt_tokens(kwargs.get('messages', [])) + (kwargs.get('max_tokens') or EXPECTED_COMPLETION_TOKENS)
+    for attempt in range(MAX_TRIES):
+        start = time.monotonic()
+        try:
+            raw_response = await send_hedged(client, chat_id, tokens, kwargs)
+            response = raw_response.parse()
+            if route is not None:
+                routing.record_latency(route, kwargs.get('model'), time.monotonic() - start)
+                if not kwargs.get('stream'):
+                    routing.record_usage(route, kwargs.get('model'), response.usage)
+            return response
+        except openai.OpenAIError as exc:
+            metrics.incr('openai_errors')
+            response = getattr(exc, 'response', None)
+            if response is not None:
+                admission.update_from_headers(response.headers)
+            if not is_retryable(exc) or attempt == MAX_TRIES - 1:
+                raise
+            delay = retry_delay(exc, attempt)
+            remaining = deadline.remaining()
+            if remaining is not None and delay >= remaining:
+                logging.error(f"Not retrying OpenAI call, {remaining:.1f}s left before the deadline")
+                raise
+            logging.warning(f"OpenAI call failed ({exc.__class__.__name__}), retrying in {delay:.1f}s")
+            metrics.incr('openai_retries')
+            await asyncio.sleep(delay)
@@ -1,43 +1,174 @@
 import logging
-import openai
-from openai import AsyncOpenAI
 import os
 import json
+import html
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, ConversationHandler, CallbackQueryHandler, filters
-from db import save_message, get_conversation_history, summarize_and_archive_messages, erase_history
-import backoff
+from db import save_message, append_and_get_history, erase_history, ensure_indexes, require_unique_indexes
 import re
 import time
 import asyncio
+import metrics
+import deadline
+from llm import create_completion
+from openai_client import get_client, prewarm
+import summary_jobs
+import update_queue
+import update_dedup
+import completion_cache
+from prompt import build_prompt, record_usage
+from routing import choose_model
+from streaming import split_reply, stream_completion, ProgressiveMessage
+from telegram_bot import CofounderBot, WebhookReply, webhook_reply
+from update_processor import ChatSerialUpdateProcessor
+from outbound import OutboundRateLimiter, Outbox, create_request
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-openai_client = AsyncOpenAI(api_key=os.getenv('COFOUNDERAI_GPT_API_KEY'))
 
-application = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+# 'batch' sends the reply once it's complete, 'stream' sends each part as soon as it's generated,
+# 'edit' shows the reply in one message that is edited while it's generated
+REPLY_MODE = os.getenv('COFOUNDERAI_REPLY_MODE', 'batch')
+
+# Time a worker needs to be left with to take another queued update (ingest mode)
+WORKER_UPDATE_TIME = float(os.getenv('COFOUNDERAI_WORKER_UPDATE_TIME', 20))
+
+# Set to 1 to send the first message of an update in the webhook response instead of a
+# separate request. Only used in 'batch' mode: 'stream' would hold back the first part until
+# the next one is generated, and 'edit' needs the id of the message it edits.
+WEBHOOK_REPLY = os.getenv('COFOUNDERAI_WEBHOOK_REPLY', '0') == '1' and REPLY_MODE == 'batch'
+
+# Sent instead of the reply when it can't be finished before the invocation's deadline
+FALLBACK_MESSAGE = "Sorry, that one is taking me longer than usual. Please send your message again in a moment."
+
+application = Application.builder().bot(
+    CofounderBot(os.getenv('TELEGRAM_TOKEN'), request=create_request(), rate_limiter=OutboundRateLimiter())
+).concurrent_updates(ChatSerialUpdateProcessor()).build()
+
+# One event loop per container. It is kept open between invocations so that the
+# initialized application (and its HTTP connection pools) survive warm starts.
+event_loop = None
+application_ready = False
+indexes_ready = False
+# Background tasks started on cold start; referenced here so they aren't garbage collected
+background_tasks = set()
+# update_id -> the error a handler raised; Application.process_update hands it to the
+# error handlers instead of raising it
+failed_updates = {}
+
+# Set to 0 to only check on cold start that the unique indexes exist, without creating
+# any index (e.g. when `migrate.py indexes` runs as a deploy step)
+ENSURE_INDEXES = os.getenv('COFOUNDERAI_ENSURE_INDEXES', '1') != '0'
+# Set to 0 to skip opening the OpenAI connection while the application initializes
+PREWARM_OPENAI = os.getenv('COFOUNDERAI_OPENAI_PREWARM', '1') != '0'
+
+
+def get_event_loop():
+    """Return the container-wide event loop, creating it on the first invocation."""
+    global event_loop
+    if event_loop is None or event_loop.is_closed():
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+    return event_loop
+
 
 def lambda_handler(event, context):
-    loop = asyncio.get_event_loop()
-    return loop.run_until_complete(main(event, context))
+    try:
+        if update_queue.INGEST_MODE:
+            return get_event_loop().run_until_complete(ingest(event, context))
+        return get_event_loop().run_until_complete(main(event, context))
+    finally:
+        report_metrics()
 
-async def main(event, context):
-    # Add conversation, command, and any other handlers
+
+def worker_handler(event, context):
+    """Entry point of the function that processes the updates queued in ingest mode."""
+    try:
+        return get_event_loop().run_until_complete(worker(event, context))
+    finally:
+        report_metrics()
+
+
+def report_metrics():
+    """Log the container's metrics, once per invocation."""
+    metrics.gauge('completion_cache_hit_rate', completion_cache.hit_rate())
+    metrics.log_snapshot()
+
+
+def register_handlers(app):
+    """Add conversation, command, and any other handlers. Must only run once per application."""
     logging.info("Adding application handlers")
-    
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("erase", erase))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    # application.add_error_handler(error_handler)
-    
-    try:    
-        await application.initialize()
-        await application.process_update(
-            Update.de_json(json.loads(event["body"]), application.bot)
-        )
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("erase", erase))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+
+    # app.add_error_handler(error_handler)
+    app.add_error_handler(record_failure)
+
+
+async def bootstrap():
+    """Initialize the application on a cold start; no-op (besides counting) on warm starts."""
+    global application_ready
+    if application_ready:
+        metrics.incr('warm_starts')
+        logging.info("Warm start, reusing initialized application")
+        return
+
+    metrics.incr('cold_starts')
+    logging.info("Cold start, initializing application")
+    if PREWARM_OPENAI:
+        # The TLS handshake with OpenAI overlaps with Telegram's initialization
+        start_background_task(prewarm())
+    await asyncio.gather(require_indexes(), application.initialize())
+    if ENSURE_INDEXES:
+        # The other indexes only speed queries up, so they run alongside the first update
+        start_background_task(ensure_indexes())
+    application_ready = True
+
+
+async def require_indexes():
+    """Wait until the unique indexes exist, once per container; raises if they can't be created."""
+    global indexes_ready
+    if not indexes_ready:
+        # The idempotency, deduplication and locking guards silently do nothing without them,
+        # so the invocation fails instead and Telegram delivers the update again
+        await require_unique_indexes(create=ENSURE_INDEXES)
+        indexes_ready = True
+
+
+def start_background_task(coro):
+    """Run a coroutine on the container's loop without awaiting it."""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def main(event, context):
+    deadline.start(context)
+    reply = WebhookReply() if WEBHOOK_REPLY else None
+    try:
+        # Every Mongo operation of the invocation shares its deadline
+        with deadline.mongo_timeout():
+            await bootstrap()
+            # Set only now so that background tasks started by bootstrap() don't see it
+            webhook_reply.set(reply)
+            await process_update_json(json.loads(event["body"]))
+            body = reply.response() if reply is not None else None
+            if body is not None:
+                # The user gets the reply only once we respond, so summarizing is left to a
+                # later invocation (the job is queued in-process and in Mongo)
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json'},
+                    'body': body
+                }
+
+            # The user already has the reply; summarize before the container gets frozen
+            await run_summary_jobs()
     
         return {
             'statusCode': 200,
@@ -52,6 +183,114 @@ async def main(event, context):
         }
 
 
+async def ingest(event, context):
+    """Ingest mode: validate and queue the update, then acknowledge it without processing it."""
+    deadline.start(context)
+    try:
+        update = update_queue.validate(event)
+    except update_queue.InvalidUpdate as e:
+        logging.warning(f"Rejected webhook call: {e}")
+        return {
+            'statusCode': 400,
+            'body': 'Invalid update'
+        }
+
+    try:
+        with deadline.mongo_timeout():
+            if update_queue.INGEST_MODE != 'local':
+                # The queue drops redeliveries through its unique update_id index
+                await require_indexes()
+            await update_queue.enqueue(update)
+    except Exception as exc:
+        # Not queued, so let Telegram deliver it again
+        logging.error(f'Error queueing update: {exc}', exc_info=True)
+        return {
+            'statusCode': 500,
+            'body': 'Failure'
+        }
+
+    if update_queue.INGEST_MODE == 'local':
+        # The stand-in queue lives in this process and nothing runs between invocations, so
+        # it's drained before answering (giving up the early acknowledgement)
+        await worker(event, context)
+    return {
+        'statusCode': 200,
+        'body': 'Queued'
+    }
+
+
+async def worker(event, context):
+    """Process queued updates until the queue is empty or the invocation runs out of time."""
+    deadline.start(context)
+    try:
+        with deadline.mongo_timeout():
+            await bootstrap()
+            # Updates of different chats run concurrently, the update processor keeps each chat in order
+            processed = await update_queue.drain(
+                process_update_json, has_time_for_update, application.update_processor.max_running_updates
+            )
+            await run_summary_jobs()
+
+        return {
+            'statusCode': 200,
+            'body': f'Processed {processed} updates'
+        }
+
+    except Exception as exc:
+        logging.error(f'Error during processing: {exc}', exc_info=True)
+        return {
+            'statusCode': 500,
+            'body': 'Failure'
+        }
+
+
+async def process_update_json(update):
+    """Process a raw update through the update processor, which serializes it with its chat's other updates."""
+    update = Update.de_json(update, application.bot)
+    await application.update_processor.process_update(update, process_update_once(update))
+
+
+async def process_update_once(update):
+    """Process the update, unless it was (or is being) processed already."""
+    if not await update_dedup.claim(update.update_id):
+        logging.info(f"Skipping update {update.update_id}, it was delivered before")
+        return
+    try:
+        await application.process_update(update)
+        error = failed_updates.pop(update.update_id, None)
+        if error is not None:
+            # Raised again so the webhook call (or the queued update) fails and is retried
+            raise error
+    except (Exception, asyncio.CancelledError):
+        # A cancelled update (e.g. a worker out of time) wasn't processed either
+        await update_dedup.release(update.update_id)
+        raise
+    await update_dedup.finish(update.update_id)
+
+
+async def record_failure(update, context):
+    """Error handler: remember the error of a failed update for process_update_once."""
+    if isinstance(update, Update):
+        failed_updates[update.update_id] = context.error
+    else:
+        logging.error(f"Error outside of an update: {context.error}", exc_info=context.error)
+
+
+def has_time_for_update():
+    remaining = deadline.remaining()
+    return remaining is None or remaining > WORKER_UPDATE_TIME
+
+
+async def run_summary_jobs():
+    """Run the queued summary jobs with the time that is left."""
+    try:
+        await deadline.run_before(summary_jobs.recover())
+        await deadline.run_before(summary_jobs.drain())
+    except asyncio.TimeoutError:
+        # Unfinished jobs stay in the summary_jobs collection and are recovered later
+        logging.warning("Out of time for summary jobs, leaving them to a later invocation")
+
+
 SYSTEM_PROMPT = {
     "role": "system", 
     "content": (
@@ -147,7 +386,8 @@ async def start(update: Update, context: CallbackContext):
         "Hit or type /help to see what I can do!"
     )
     
-    # Wait for 3 seconds before asking for more details
+    # Wait for 3 seconds before asking for more details, with the welcome message already delivered
+    await context.bot.flush_webhook_reply()
     await asyncio.sleep(3)
 
     # Follow-up message to ask for user's name and business
@@ -176,7 +416,7 @@ async def help_command(update: Update, context: CallbackContext):
 async def erase(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     logging.info(f"Erase command called by user: {update.effective_user.id} in chat: {chat_id}")
-    erase_history(chat_id)  # Directly call the erase_history function
+    await erase_history(chat_id)
     await update.message.reply_text("All chat history has been erased.")
 
 
@@ -186,7 +426,6 @@ async def echo(update: Update, context: CallbackContext):
 
 
 
-@backoff.on_exception(backoff.expo, (openai.APIError, openai.RateLimitError), max_tries=5)
 async def handle_message(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     text = update.message.text.strip()
@@ -194,38 +433,102 @@ async def handle_message(update: Update, context: CallbackContext):
     if not text:
         return  # Ignore empty messages
 
-    # Save the incoming message as usual
-    save_message(chat_id, 'user', text)
-
-    # Get conversation history
-
-    user_messages = [{'role': 'user', 'content': text}]
-    history = [SYSTEM_PROMPT] + get_conversation_history(chat_id) + user_messages
-    
-    # Send to OpenAI API and get response
-    response = await openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=history
-    )
-    gpt_response = response.choices[0].message.content
+    # Save the incoming message and get the conversation history (ending with it) in one go
+    message_id = update.message.message_id
+    conversation_history, message_count = await append_and_get_history(chat_id, 'user', text, message_id)
+    history = build_prompt(SYSTEM_PROMPT, conversation_history)
     
-    # Save the assistant's response
-    save_message(chat_id, 'assistant', gpt_response)
-    
-    # Summarize and archive messages if needed
-    await summarize_and_archive_messages(chat_id)
+    # Parts are sent without waiting for each other; the rate limiter keeps them in order
+    async with Outbox(context.bot, chat_id) as outbox:
+        async def send_part(part):
+            outbox.send(text=format_bold_text(part), parse_mode='HTML')
+
+        try:
+            # Stop early enough that the user can still be told, instead of Lambda timing out
+            # and Telegram redelivering the update
+            await deadline.run_before(reply(chat_id, message_id, history, send_part, context), deadline.FALLBACK_RESERVE)
+        except asyncio.TimeoutError:
+            metrics.incr('deadline_fallbacks')
+            logging.warning(f"Reply for chat_id: {chat_id} didn't finish before the deadline, sending fallback message")
+            outbox.send(text=FALLBACK_MESSAGE)
+            return
+
+    if message_count is not None:
+        message_count += 1
+
+    # Summarize and archive messages if needed, once the reply has been delivered
+    await summary_jobs.enqueue(chat_id, message_count)
+
+
+async def reply(chat_id, message_id, history, send_part, context):
+    """Generate, store and send the reply to the prompt in history."""
+    model = choose_model('reply', history)
+    gpt_response = await completion_cache.get(model, history)
+    if gpt_response is not None:
+        # A cached reply is complete already, so it's sent in parts whatever the reply mode
+        await save_message(chat_id, 'assistant', gpt_response, reply_to=message_id)
+        for part in split_reply(gpt_response):
+            await send_part(part)
+    elif REPLY_MODE == 'edit':
+        # Show the reply in one message that grows while the model generates it
+        message = ProgressiveMessage(context.bot, chat_id, format_bold_text, format_partial_bold_text)
+        await message.start()
+        gpt_response, usage = await stream_completion(
+            get_client(), chat_id, on_text=message.update, route='reply',
+            model=model,
+            messages=history
+        )
+        record_usage(usage)
+        await save_message(chat_id, 'assistant', gpt_response, reply_to=message_id)
+        if not await message.finish(gpt_response):
+            # Too long for a single message, send it in parts as usual
+            await message.discard()
+            for part in split_reply(gpt_response):
+                await send_part(part)
+        await completion_cache.put(model, history, gpt_response, usage)
+    elif REPLY_MODE == 'stream':
+        # Send each part as soon as the model has finished generating it
+        gpt_response, usage = await stream_completion(
+            get_client(), chat_id, send_part, route='reply',
+            model=model,
+            messages=history
+        )
+        record_usage(usage)
+        await save_message(chat_id, 'assistant', gpt_response, reply_to=message_id)
+        await completion_cache.put(model, history, gpt_response, usage)
+    else:
+        # Send to OpenAI API and get response
+        response = await create_completion(
+            get_client(), chat_id, 'reply',
+            model=model,
+            messages=history
+        )
+        gpt_response = response.choices[0].message.content
+        record_usage(response.usage)
 
+        # Save the assistant's response
+        await save_message(chat_id, 'assistant', gpt_response, reply_to=message_id)
 
-    parts = re.split(r'(?<=\?)\s+|(?<=\n)\s*\n|\n(?=[^•\n]*$)', gpt_response)
-    for part in parts:
-        if part.strip():
-            formatted_part = format_bold_text(part)
-            await context.bot.send_message(chat_id=chat_id, text=formatted_part, parse_mode='HTML')
+        for part in split_reply(gpt_response):
+            await send_part(part)
+        await completion_cache.put(model, history, gpt_response, response.usage)
 
     
 def format_bold_text(text):
     """Replace '**' around words, phrases, or sentences with the Telegram Bot API's bold formatting."""
-    return re.sub(r'\*\*(.*?)\*\*', lambda match: f'<b>{match.group(1)}</b>', text)
+    # Escape <, > and & first so text from the model can't break the HTML parse mode
+    return re.sub(r'\*\*(.*?)\*\*', lambda match: f'<b>{match.group(1)}</b>', html.escape(text, quote=False))
+
+
+def format_partial_bold_text(text):
+    """format_bold_text for a reply that is still being generated: an unclosed '**' is dropped."""
+    if text.endswith('*') and not text.endswith('**'):
+        # Possibly the first half of a '**' that is still being streamed
+        text = text[:-1]
+    if text.count('**') % 2:
+        index = text.rfind('**')
+        text = text[:index] + text[index + 2:]
+    return format_bold_text(text)
 
 
 async def error_handler(update, context):
@@ -245,5 +548,9 @@ async def error_handler(update, context):
 #     return ConversationHandler.END
 
 
+# Handlers are registered once at import time so warm invocations keep a flat handler list
+register_handlers(application)
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import logging
+from collections import defaultdict
+
+
+# In-process counters and timings. They live for as long as the Lambda container
+# stays warm, so they describe the container's lifetime rather than one request.
+counters = defaultdict(int)
+observations = {}
+# Latest value of derived figures (rates, sizes), set when they are reported
+gauges = {}
+
+
+def incr(name, value=1):
+    """Increment the named counter."""
+    counters[name] += value
+
+
+def observe(name, value):
+    """Record a sample (latency, size, ...) keeping count, total, min and max."""
+    stats = observations.get(name)
+    if stats is None:
+        observations[name] = {"count": 1, "total": value, "min": value, "max": value}
+        return
+    stats["count"] += 1
+    stats["total"] += value
+    stats["min"] = min(stats["min"], value)
+    stats["max"] = max(stats["max"], value)
+
+
+def gauge(name, value):
+    """Set the named gauge to its current value."""
+    gauges[name] = value
+
+
+def snapshot():
+    """Return a copy of all counters, gauges and observations, with averages filled in."""
+    result = {"counters": dict(counters), "gauges": dict(gauges), "observations": {}}
+    for name, stats in observations.items():
+        result["observations"][name] = dict(stats, avg=stats["total"] / stats["count"])
+    return result
+
+
+def log_snapshot():
+    """Log the current metrics snapshot."""
+    logging.info(f"Metrics: {snapshot()}")
@@ -0,0 +1,103 @@
+"""Schema management for the ChatHistory database.
+
+indexes: report (--check) or create the indexes declared in db.INDEXES. Exits with 1 while
+any of them is missing, so a deploy can run it as a step that must pass.
+
+erased-messages: older conversation documents keep every /erase snapshot in an
+`erased_messages` array. This moves those snapshots into the `erased_conversations`
+collection and drops the array from the head document. Running it again is safe:
+snapshots are upserted by (chat_id, erased_at) and migrated documents are skipped.
+
+Usage:
+    python migrate.py indexes [--check]
+    python migrate.py erased-messages [--dry-run] [--batch-size N]
+"""
+import argparse
+import asyncio
+import logging
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from db import conversations, erased_conversations, ensure_indexes, missing_indexes
+
+
+async def migrate_erased_messages(batch_size=100, dry_run=False):
+    """Move embedded erased_messages snapshots into erased_conversations."""
+    migrated_chats = 0
+    migrated_snapshots = 0
+
+    cursor = conversations.find(
+        {"erased_messages": {"$exists": True}},
+        {"_id": 1, "chat_id": 1, "erased_messages": 1},
+        batch_size=batch_size
+    )
+    async for conversation in cursor:
+        chat_id = conversation['chat_id']
+        snapshots = conversation.get('erased_messages') or []
+        requests = [
+            UpdateOne(
+                {"chat_id": chat_id, "erased_at": snapshot.get('archived_at')},
+                {"$setOnInsert": {
+                    "chat_id": chat_id,
+                    "erased_at": snapshot.get('archived_at'),
+                    "messages": snapshot.get('messages', []),
+                    "archived_messages": snapshot.get('archived_messages', [])
+                }},
+                upsert=True
+            )
+            for snapshot in snapshots
+        ]
+
+        if dry_run:
+            logging.info(f"Would move {len(requests)} erased snapshots of chat_id: {chat_id}")
+        else:
+            try:
+                if requests:
+                    await erased_conversations.bulk_write(requests, ordered=False)
+                # Only drop the array if nothing was erased again while we were copying it
+                await conversations.update_one(
+                    {"_id": conversation['_id'], "erased_messages": {"$size": len(snapshots)}},
+                    {"$unset": {"erased_messages": ""}}
+                )
+            except PyMongoError as e:
+                logging.error(f"Failed to migrate chat_id: {chat_id}. Error: {str(e)}")
+                continue
+
+        migrated_chats += 1
+        migrated_snapshots += len(requests)
+
+    logging.info(f"Migrated {migrated_snapshots} erased snapshots from {migrated_chats} conversations")
+    return migrated_chats, migrated_snapshots
+
+
+async def check_indexes():
+    """Log the declared indexes that don't exist yet."""
+    missing = await missing_indexes()
+    for collection_name, index_name in missing:
+        logging.warning(f"Missing index {index_name} on {collection_name}")
+    if not missing:
+        logging.info("All declared indexes exist")
+    return missing
+
+
+async def run(args):
+    if args.command == 'indexes':
+        if args.check:
+            return 1 if await check_indexes() else 0
+        await ensure_indexes()
+        return 1 if await check_indexes() else 0
+    await migrate_erased_messages(batch_size=args.batch_size, dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    indexes_parser = subparsers.add_parser('indexes', help="create the declared indexes")
+    indexes_parser.add_argument('--check', action='store_true', help="only report missing indexes")
+
+    erased_parser = subparsers.add_parser('erased-messages', help="move erased_messages out of conversation documents")
+    erased_parser.add_argument('--dry-run', action='store_true', help="only report what would be migrated")
+    erased_parser.add_argument('--batch-size', type=int, default=100, help="conversations fetched per cursor batch")
+
+    raise SystemExit(asyncio.run(run(parser.parse_args())))
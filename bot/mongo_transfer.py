@@ -0,0 +1,118 @@
+"""Measure how many bytes each data-layer operation pulls from MongoDB.
+
+Every function in db.py is wrapped with @track(<operation>). When the listener is
+enabled (COFOUNDERAI_MONGO_TRANSFER_METRICS=1) the size of every command reply is
+added to the running operation and reported to metrics as mongo_bytes.<operation>.
+Operations that receive more than their budget are logged, and in strict mode
+(COFOUNDERAI_MONGO_TRANSFER_STRICT=1) they raise TransferBudgetExceeded, which makes
+the budgets usable as assertions in a staging run or a test suite.
+"""
+import contextvars
+import functools
+import logging
+import os
+import bson
+from pymongo import monitoring
+import metrics
+
+
+ENABLED = os.getenv('COFOUNDERAI_MONGO_TRANSFER_METRICS', '0') == '1'
+STRICT = os.getenv('COFOUNDERAI_MONGO_TRANSFER_STRICT', '0') == '1'
+
+# Size of a typical stored message (BSON, with role, timestamp and ids) and of a chat's
+# archived summaries. Budgets of reads that return a message window are sized from these.
+MESSAGE_BYTES = 2 * 1024
+SUMMARIES_BYTES = 16 * 1024
+
+
+def window_budget(messages):
+    """Budget of a read returning up to messages messages plus the archived summaries."""
+    return messages * MESSAGE_BYTES + SUMMARIES_BYTES
+
+
+# Maximum bytes received per operation, meant to catch reads that pull whole documents
+# (e.g. erased history) instead of a projection. db.py sets the budgets of the reads
+# that return a message window, which depend on HISTORY_WINDOW.
+TRANSFER_BUDGETS = {
+    "save_message": 4 * 1024,
+    "enqueue_summary_job": 4 * 1024,
+    "claim_summary_job": 4 * 1024,
+    "complete_summary_job": 4 * 1024,
+    "find_summary_jobs": 16 * 1024,
+    "get_cached_completion": 64 * 1024,
+    "save_cached_completion": 4 * 1024,
+    "get_bot_identity": 4 * 1024,
+    "save_bot_identity": 4 * 1024,
+    "enqueue_update": 4 * 1024,
+    "claim_update": 64 * 1024,
+    "complete_update": 4 * 1024,
+    "release_update": 4 * 1024,
+    "requeue_update": 4 * 1024,
+    "claim_processed_update": 4 * 1024,
+    "finish_processed_update": 4 * 1024,
+    "release_processed_update": 4 * 1024,
+    "acquire_chat_lease": 4 * 1024,
+    "release_chat_lease": 4 * 1024,
+}
+
+# Bytes received so far by the operation running in the current context
+current_transfer = contextvars.ContextVar('current_transfer', default=None)
+
+
+class TransferBudgetExceeded(AssertionError):
+    pass
+
+
+class TransferListener(monitoring.CommandListener):
+    """Adds the BSON size of every command reply to the running operation."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        transfer = current_transfer.get()
+        if transfer is not None:
+            transfer['bytes'] += len(bson.encode(event.reply))
+            transfer['commands'] += 1
+
+    def failed(self, event):
+        pass
+
+
+def event_listeners():
+    """Listeners to register on the Mongo client."""
+    return [TransferListener()] if ENABLED else []
+
+
+def track(operation):
+    """Decorate an async data-layer function so its Mongo transfer is measured."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            transfer = {'bytes': 0, 'commands': 0}
+            token = current_transfer.set(transfer)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                current_transfer.reset(token)
+                check_budget(operation, transfer)
+        return wrapper
+    return decorator
+
+
+def check_budget(operation, transfer):
+    """Report the bytes one operation received and enforce its budget."""
+    metrics.observe(f"mongo_bytes.{operation}", transfer['bytes'])
+    metrics.observe(f"mongo_commands.{operation}", transfer['commands'])
+
+    budget = TRANSFER_BUDGETS.get(operation)
+    if budget is None or transfer['bytes'] <= budget:
+        return
+    metrics.incr('mongo_transfer_budget_exceeded')
+    message = f"{operation} received {transfer['bytes']} bytes from MongoDB, over its budget of {budget}"
+    if STRICT:
+        raise TransferBudgetExceeded(message)
+    logging.warning(message)
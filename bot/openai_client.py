@@ -0,0 +1,62 @@
+"""The container's single AsyncOpenAI client.
+
+Everything that talks to OpenAI (replies in main.py, summaries in db.py) shares this
+client and therefore one httpx connection pool, so a warm container reuses its
+keep-alive TLS connection instead of every caller doing its own handshake. Timeouts
+are sized for Lambda instead of the library's 600 s default, and retries are left to
+llm.create_completion.
+"""
+import logging
+import os
+import httpx
+from openai import AsyncOpenAI
+import metrics
+
+
+CONNECT_TIMEOUT = float(os.getenv('COFOUNDERAI_OPENAI_CONNECT_TIMEOUT', 3))
+READ_TIMEOUT = float(os.getenv('COFOUNDERAI_OPENAI_READ_TIMEOUT', 60))
+WRITE_TIMEOUT = 10
+POOL_TIMEOUT = 5
+
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+# Long enough to carry a connection across warm invocations a few seconds apart
+KEEPALIVE_EXPIRY = 120
+
+client = None
+http_client = None
+
+
+def get_client():
+    """Return the shared client, creating it on first use."""
+    global client, http_client
+    if client is None:
+        timeout = httpx.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT)
+        http_client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY
+            )
+        )
+        client = AsyncOpenAI(
+            api_key=os.getenv('COFOUNDERAI_GPT_API_KEY'),
+            timeout=timeout,
+            max_retries=0,
+            http_client=http_client
+        )
+    return client
+
+
+async def prewarm():
+    """Open the TLS connection to the API ahead of the first completion.
+
+    Any response (it's an unauthenticated HEAD) leaves a keep-alive connection in the pool.
+    """
+    openai_client = get_client()
+    try:
+        await http_client.head(str(openai_client.base_url))
+        metrics.incr('openai_prewarms')
+    except httpx.HTTPError as e:
+        logging.warning(f"Pre-warming the OpenAI connection failed: {e}")
@@ -0,0 +1,149 @@
+"""Outbound Telegram delivery: rate limiting, flood control and pipelined sends.
+
+Every Bot API request of the application goes through OutboundRateLimiter (a
+telegram.ext.BaseRateLimiter, since AIORateLimiter needs aiolimiter). It keeps the
+requests of a chat in order, stays under Telegram's overall and per-group limits and
+waits out RetryAfter instead of failing. Because ordering is kept here, handlers don't
+have to wait for one message to arrive before sending the next: Outbox starts the sends
+of a reply right away and only waits for all of them at the end.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from telegram.request import HTTPXRequest
+from chat_locks import ChatLocks
+import deadline
+import metrics
+
+
+# Telegram's documented limits: about 30 messages per second overall, 20 per minute in a group
+OVERALL_MAX_RATE = 30
+OVERALL_PERIOD = 1
+GROUP_MAX_RATE = 20
+GROUP_PERIOD = 60
+# How often a request hit by RetryAfter is retried; pass rate_limit_args={"max_retries": 0} to opt out
+MAX_RETRIES = 2
+
+# Connections to the Bot API kept by the bot's request object (python-telegram-bot's default is 1)
+CONNECTION_POOL_SIZE = int(os.getenv('COFOUNDERAI_TELEGRAM_POOL_SIZE', 8))
+
+
+class SlidingWindow:
+    """Allows at most max_rate events per period seconds."""
+
+    def __init__(self, max_rate, period):
+        self.max_rate = max_rate
+        self.period = period
+        self.times = deque()
+
+    def wait_time(self):
+        """Seconds until another event is allowed."""
+        now = time.monotonic()
+        while self.times and now - self.times[0] >= self.period:
+            self.times.popleft()
+        if len(self.times) < self.max_rate:
+            return 0
+        return self.period - (now - self.times[0])
+
+    def record(self):
+        self.times.append(time.monotonic())
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Orders requests per chat, applies the overall and group limits and retries on RetryAfter."""
+
+    def __init__(self, max_retries=MAX_RETRIES):
+        self.max_retries = max_retries
+        self.overall = SlidingWindow(OVERALL_MAX_RATE, OVERALL_PERIOD)
+        # Few groups use the bot, so their windows are simply kept
+        self.groups = {}
+        self.chat_locks = ChatLocks()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def admit(self, chat_id):
+        """Wait until the request fits the overall limit and, for groups, the group's limit."""
+        group = None
+        if isinstance(chat_id, int) and chat_id < 0:
+            group = self.groups.setdefault(chat_id, SlidingWindow(GROUP_MAX_RATE, GROUP_PERIOD))
+        start = time.monotonic()
+        while True:
+            delay = max(self.overall.wait_time(), group.wait_time() if group is not None else 0)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self.overall.record()
+        if group is not None:
+            group.record()
+        metrics.observe('telegram_admission_wait_seconds', time.monotonic() - start)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = (rate_limit_args or {}).get('max_retries', self.max_retries)
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await self.send(callback, args, kwargs, endpoint, chat_id, max_retries)
+        # Requests of a chat are sent one after the other, in the order they were made
+        async with self.chat_locks.get(chat_id):
+            return await self.send(callback, args, kwargs, endpoint, chat_id, max_retries)
+
+    async def send(self, callback, args, kwargs, endpoint, chat_id, max_retries):
+        for attempt in range(max_retries + 1):
+            await self.admit(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.incr('telegram_flood_waits')
+                if attempt == max_retries:
+                    raise
+                remaining = deadline.remaining()
+                if remaining is not None and e.retry_after >= remaining:
+                    raise
+                # Holding the chat's lock pauses the chat's other requests as well
+                logging.warning(f"Telegram flood control on {endpoint} for chat_id: {chat_id}, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+
+
+def create_request():
+    """Request object for the bot's Bot API calls, with a pool sized for concurrent sends."""
+    return HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE)
+
+
+class Outbox:
+    """Sends a chat's messages without waiting for each one; the rate limiter keeps their order.
+
+    Use as `async with Outbox(bot, chat_id) as outbox:`. Leaving the block waits for every
+    send, or cancels the unfinished ones if the block raised.
+    """
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.pending = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            for task in self.pending:
+                task.cancel()
+            return False
+        await self.flush()
+        return False
+
+    def send(self, **kwargs):
+        """Start sending a message to the chat."""
+        self.pending.append(asyncio.ensure_future(self.bot.send_message(chat_id=self.chat_id, **kwargs)))
+
+    async def flush(self):
+        """Wait until everything sent so far was delivered; raises the first failure."""
+        pending, self.pending = self.pending, []
+        await asyncio.gather(*pending)
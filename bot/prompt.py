@@ -0,0 +1,125 @@
+"""Prompt assembly under a token budget.
+
+Tokens are estimated locally (no tokenizer download, no network). The estimate follows
+how GPT tokenizers split English text: common words are a single token, long words
+and numbers are split into chunks, every punctuation mark and line break is a token and
+each chat message carries a fixed framing overhead. Compare the prompt_tokens and
+prompt_tokens_estimated metrics to recalibrate.
+"""
+import os
+import re
+import metrics
+
+
+# Prompt tokens sent with every reply (system prompt, summaries, turns and the new message)
+CONTEXT_BUDGET = int(os.getenv('COFOUNDERAI_CONTEXT_BUDGET', 3000))
+# Most recent turns (before the new message) that are only dropped once the summaries are cut down
+MIN_RECENT_TURNS = int(os.getenv('COFOUNDERAI_MIN_RECENT_TURNS', 6))
+
+# Framing tokens per message and for priming the reply, as documented for gpt-3.5-turbo
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d+|\n|[^\w\s]")
+ASCII_CHARS_PER_TOKEN = 8
+NON_ASCII_CHARS_PER_TOKEN = 2
+DIGITS_PER_TOKEN = 3
+
+# Marker appended to a summary that had to be cut to fit the budget
+TRUNCATION_MARKER = " [...]"
+
+
+def estimate_tokens(text):
+    """Estimate the number of tokens the model will see for the text."""
+    tokens = 0
+    for piece in TOKEN_PATTERN.findall(text):
+        if piece.isdigit():
+            tokens += -(-len(piece) // DIGITS_PER_TOKEN)
+        elif piece.isascii():
+            tokens += -(-len(piece) // ASCII_CHARS_PER_TOKEN)
+        else:
+            tokens += -(-len(piece) // NON_ASCII_CHARS_PER_TOKEN)
+    return tokens
+
+
+def estimate_message_tokens(message):
+    return TOKENS_PER_MESSAGE + estimate_tokens(message['content'])
+
+
+def estimate_prompt_tokens(messages):
+    return TOKENS_PER_REPLY + sum(estimate_message_tokens(message) for message in messages)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text so that it (plus the truncation marker) fits into max_tokens."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - estimate_tokens(TRUNCATION_MARKER)
+    if budget <= 0:
+        return ""
+    # Cut on a piece boundary, keeping the beginning where summaries put the key facts
+    used = 0
+    end = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        used += estimate_tokens(match.group(0))
+        if used > budget:
+            break
+        end = match.end()
+    return text[:end] + TRUNCATION_MARKER
+
+
+def build_prompt(system_prompt, history, budget=CONTEXT_BUDGET, min_recent_turns=MIN_RECENT_TURNS):
+    """Assemble the messages for a chat completion within the token budget.
+
+    history is what db.format_history returns: archived summaries (system messages)
+    followed by the conversation turns, ending with the new user message. The system
+    prompt and the new message are always kept. The oldest turns are dropped first, down
+    to the last min_recent_turns; if that isn't enough, the summaries are cut down, oldest
+    first, and only then the remaining recent turns are dropped.
+    """
+    summary_count = 0
+    while summary_count < len(history) and history[summary_count]['role'] == 'system':
+        summary_count += 1
+    summaries = list(history[:summary_count])
+    turns = list(history[summary_count:])
+    latest = turns[-1:]
+    earlier = turns[:-1]
+
+    total = estimate_prompt_tokens([system_prompt] + summaries + turns)
+    dropped = 0
+    while len(earlier) > min_recent_turns and total > budget:
+        total -= estimate_message_tokens(earlier.pop(0))
+        dropped += 1
+
+    compacted = 0
+    for index, summary in enumerate(summaries):
+        if total <= budget:
+            break
+        summary_tokens = estimate_tokens(summary['content'])
+        allowed = max(0, summary_tokens - (total - budget))
+        content = truncate_to_tokens(summary['content'], allowed)
+        summaries[index] = {"role": summary['role'], "content": content}
+        total -= summary_tokens - estimate_tokens(content)
+        compacted += 1
+
+    while earlier and total > budget:
+        total -= estimate_message_tokens(earlier.pop(0))
+        dropped += 1
+
+    metrics.observe('prompt_tokens_estimated', total)
+    if dropped:
+        metrics.incr('prompt_turns_dropped', dropped)
+    if compacted:
+        metrics.incr('prompt_summaries_compacted', compacted)
+    if total > budget:
+        metrics.incr('prompt_over_budget')
+
+    return [system_prompt] + [summary for summary in summaries if summary['content']] + earlier + latest
+
+
+def record_usage(usage):
+    """Report the token usage the API returned for a completion."""
+    if usage is None:
+        return
+    metrics.observe('prompt_tokens', usage.prompt_tokens)
+    metrics.observe('completion_tokens', usage.completion_tokens)
@@ -0,0 +1,146 @@
+"""Client-side admission control for OpenAI requests.
+
+Every completion waits for a slot in two token buckets, requests per minute and tokens
+per minute, before it is sent. The buckets start from the configured limits and are
+corrected from the x-ratelimit-* headers of every response, so a burst of users is
+queued here instead of tripping RateLimitError and fanning out into retries. Waiting
+callers are served round robin per chat, so one busy chat can't starve the others.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+import metrics
+
+
+REQUESTS_PER_MINUTE = int(os.getenv('COFOUNDERAI_OPENAI_RPM', 500))
+TOKENS_PER_MINUTE = int(os.getenv('COFOUNDERAI_OPENAI_TPM', 200000))
+
+
+class TokenBucket:
+    """Holds up to capacity units and refills them evenly over a minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """Seconds until amount units are available."""
+        self.refill()
+        # A single request larger than the bucket waits for a full bucket instead of forever
+        missing = min(amount, self.capacity) - self.available
+        return max(0, missing * 60 / self.capacity)
+
+    def consume(self, amount):
+        self.refill()
+        self.available -= amount
+
+    def update(self, limit, remaining):
+        """Adopt the limit and remaining budget the API reported."""
+        self.refill()
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.available = min(self.available, remaining)
+
+
+class AdmissionController:
+    """Admits requests within the RPM/TPM budgets, serving waiting chats round robin."""
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        # chat_id -> deque of (future, tokens); the order of the keys is the round robin
+        self.waiting = OrderedDict()
+        self.dispatcher = None
+        self.wakeup = None
+
+    @property
+    def queue_depth(self):
+        return sum(len(waiters) for waiters in self.waiting.values())
+
+    async def acquire(self, chat_id, tokens):
+        """Wait until a request of about `tokens` tokens may be sent for the chat."""
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(chat_id, deque()).append((waiter, tokens))
+        metrics.observe('openai_admission_queue_depth', self.queue_depth)
+        self.wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            self.remove(chat_id, waiter)
+            raise
+        metrics.observe('openai_admission_wait_seconds', time.monotonic() - start)
+
+    def remove(self, chat_id, waiter):
+        waiters = self.waiting.get(chat_id)
+        if not waiters:
+            return
+        for entry in list(waiters):
+            if entry[0] is waiter:
+                waiters.remove(entry)
+        if not waiters:
+            del self.waiting[chat_id]
+
+    def wake(self):
+        if self.dispatcher is None or self.dispatcher.done():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.get_running_loop().create_task(self.dispatch())
+        else:
+            self.wakeup.set()
+
+    async def dispatch(self):
+        """Grant slots while there are waiters, one chat at a time in turn."""
+        while self.waiting:
+            chat_id, waiters = next(iter(self.waiting.items()))
+            waiter, tokens = waiters[0]
+            delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if delay > 0:
+                # Header updates or cancellations may change the picture; re-check on wakeup
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            waiters.popleft()
+            self.waiting.move_to_end(chat_id)
+            if not waiters:
+                del self.waiting[chat_id]
+            if waiter.done():
+                continue
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            waiter.set_result(None)
+
+    def update_from_headers(self, headers):
+        """Correct the buckets from a response's x-ratelimit-* headers."""
+        if headers is None:
+            return
+        try:
+            self.requests.update(
+                int(headers['x-ratelimit-limit-requests']) if 'x-ratelimit-limit-requests' in headers else None,
+                int(headers['x-ratelimit-remaining-requests']) if 'x-ratelimit-remaining-requests' in headers else None
+            )
+            self.tokens.update(
+                int(headers['x-ratelimit-limit-tokens']) if 'x-ratelimit-limit-tokens' in headers else None,
+                int(headers['x-ratelimit-remaining-tokens']) if 'x-ratelimit-remaining-tokens' in headers else None
+            )
+        except ValueError as e:
+            logging.warning(f"Unexpected rate limit headers from OpenAI: {e}")
+            return
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+
+# Shared by every OpenAI call in the container
+admission = AdmissionController()
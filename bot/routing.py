@@ -0,0 +1,105 @@
+"""Model routing per call type and request size/complexity.
+
+Every OpenAI call names its route: 'reply' for answers to the user, 'archive' for chunk
+summaries and 'merge' for folding them into the top-level summary. A route is a list
+of tiers checked in order; the first tier whose limits the request fits picks the
+model, and the last tier is the fallback. Limits are max_prompt_tokens (estimated) and
+max_complexity (0-1, see complexity()). For example, to keep short turns and archival
+on a cheap model and send long or demanding questions to a heavier one:
+
+    COFOUNDERAI_MODEL_ROUTES='{
+        "reply": [{"model": "gpt-3.5-turbo", "max_prompt_tokens": 2000, "max_complexity": 0.5},
+                  {"model": "gpt-4o"}],
+        "archive": [{"model": "gpt-3.5-turbo"}],
+        "merge": [{"model": "gpt-3.5-turbo"}]
+    }'
+
+Latency, token usage and estimated cost are reported per route and model as metrics.
+"""
+import json
+import logging
+import os
+import re
+import metrics
+from prompt import estimate_prompt_tokens
+
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+DEFAULT_ROUTES = {
+    "reply": [{"model": DEFAULT_MODEL}],
+    "archive": [{"model": DEFAULT_MODEL}],
+    "merge": [{"model": DEFAULT_MODEL}],
+}
+
+# USD per million prompt and completion tokens, for the cost estimates
+PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (5.0, 15.0),
+}
+
+# Words that suggest a question needs more than a quick answer
+COMPLEX_PATTERN = re.compile(
+    r'\b(strategy|strategies|plan|roadmap|model|forecast|valuation|compare|comparison|trade-?offs?|'
+    r'analy[sz]e|analysis|pricing|financial|projections?|step by step|in detail|why)\b',
+    re.IGNORECASE
+)
+
+
+def load_routes():
+    raw = os.getenv('COFOUNDERAI_MODEL_ROUTES')
+    if not raw:
+        return DEFAULT_ROUTES
+    try:
+        routes = json.loads(raw)
+    except ValueError as e:
+        logging.error(f"Invalid COFOUNDERAI_MODEL_ROUTES, using the default routes: {e}")
+        return DEFAULT_ROUTES
+    return dict(DEFAULT_ROUTES, **routes)
+
+
+ROUTES = load_routes()
+
+
+def complexity(text):
+    """Rough 0-1 score of how demanding a message is: length, questions, and analysis words."""
+    score = min(len(text) / 1200, 0.4)
+    score += min(text.count('?') * 0.1, 0.2)
+    score += min(len(COMPLEX_PATTERN.findall(text)) * 0.1, 0.4)
+    return min(score, 1.0)
+
+
+def choose_model(route, messages):
+    """Pick the model for a call on the route with the given prompt messages."""
+    tiers = ROUTES.get(route) or DEFAULT_ROUTES.get(route) or [{"model": DEFAULT_MODEL}]
+    prompt_tokens = estimate_prompt_tokens(messages)
+    score = complexity(messages[-1]['content']) if messages else 0.0
+
+    for tier in tiers:
+        if prompt_tokens > tier.get('max_prompt_tokens', float('inf')):
+            continue
+        if score > tier.get('max_complexity', float('inf')):
+            continue
+        model = tier['model']
+        break
+    else:
+        model = tiers[-1]['model']
+
+    metrics.incr(f'route.{route}.{model}.calls')
+    return model
+
+
+def record_latency(route, model, seconds):
+    metrics.observe(f'route.{route}.{model}.seconds', seconds)
+
+
+def record_usage(route, model, usage):
+    """Report the tokens and estimated cost of a call on the route."""
+    if usage is None:
+        return
+    metrics.incr(f'route.{route}.{model}.prompt_tokens', usage.prompt_tokens)
+    metrics.incr(f'route.{route}.{model}.completion_tokens', usage.completion_tokens)
+    prices = PRICES.get(model)
+    if prices is not None:
+        cost = (usage.prompt_tokens * prices[0] + usage.completion_tokens * prices[1]) / 1000000
+        metrics.observe(f'route.{route}.{model}.cost_usd', cost)
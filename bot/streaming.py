@@ -0,0 +1,188 @@
+"""Streaming chat completions, delivered part by part as they are generated.
+
+Replies are split into Telegram messages with REPLY_SPLIT_PATTERN: after a question,
+at blank lines, and before a trailing line that isn't a bullet point. While the
+completion streams, the first two boundaries can be recognized as soon as some text
+follows them, so every part before them is sent right away. The trailing-line rule
+depends on the end of the reply and is applied once the stream is finished.
+
+Alternatively, ProgressiveMessage shows the reply in one message that is edited as
+the completion streams.
+"""
+import logging
+import os
+import re
+import time
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter, TelegramError
+import metrics
+from llm import create_completion
+import routing
+
+
+REPLY_SPLIT_PATTERN = re.compile(r'(?<=\?)\s+|(?<=\n)\s*\n|\n(?=[^•\n]*$)')
+STREAM_BOUNDARY_PATTERN = re.compile(r'(?<=\?)\s+|(?<=\n)\s*\n')
+
+# Cadence of progressive edits; Telegram rejects frequent edits of the same message
+EDIT_INTERVAL = float(os.getenv('COFOUNDERAI_EDIT_INTERVAL', 1.5))
+EDIT_MIN_CHARS = 40
+PLACEHOLDER = '…'
+
+
+def split_reply(text):
+    """Split a complete reply into the parts sent as separate messages."""
+    return [part for part in REPLY_SPLIT_PATTERN.split(text) if part.strip()]
+
+
+class ReplySplitter:
+    """Incrementally splits streamed text into the same parts as split_reply."""
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, text):
+        """Add streamed text and return the parts that are complete now."""
+        self.buffer += text
+        parts = []
+        while True:
+            match = STREAM_BOUNDARY_PATTERN.search(self.buffer)
+            # A boundary at the end of the buffer may still grow; wait for text after it
+            if match is None or not self.buffer[match.end():].strip():
+                break
+            parts.append(self.buffer[:match.start()])
+            self.buffer = self.buffer[match.end():]
+        return [part for part in parts if part.strip()]
+
+    def close(self):
+        """Return the remaining parts once the stream is finished."""
+        parts = split_reply(self.buffer)
+        self.buffer = ''
+        return parts
+
+
+async def stream_completion(client, chat_id=None, send_part=None, on_text=None, route=None, **kwargs):
+    """Create a streaming chat completion and report its progress while it's generated.
+
+    send_part is awaited with each part as soon as it's complete, on_text with the whole
+    reply generated so far after every chunk. Returns the full reply text and the token
+    usage reported at the end of the stream.
+    """
+    start = time.monotonic()
+    # Only opening the stream is retried; once parts were sent a retry would repeat them
+    stream = await create_completion(
+        client, chat_id, route,
+        stream=True,
+        stream_options={"include_usage": True},
+        **kwargs
+    )
+
+    splitter = ReplySplitter()
+    chunks = []
+    usage = None
+    parts_sent = 0
+
+    async def send(part):
+        nonlocal parts_sent
+        if parts_sent == 0:
+            metrics.observe('stream_first_part_seconds', time.monotonic() - start)
+        parts_sent += 1
+        await send_part(part)
+
+    async for chunk in stream:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        chunks.append(chunk.choices[0].delta.content)
+        if send_part is not None:
+            for part in splitter.feed(chunk.choices[0].delta.content):
+                await send(part)
+        if on_text is not None:
+            await on_text(''.join(chunks))
+
+    if send_part is not None:
+        for part in splitter.close():
+            await send(part)
+    metrics.observe('stream_seconds', time.monotonic() - start)
+    if route is not None:
+        routing.record_usage(route, kwargs.get('model'), usage)
+    return ''.join(chunks), usage
+
+
+class ProgressiveMessage:
+    """A single Telegram message that is edited in place while the reply is generated.
+
+    Edits are coalesced to at most one per EDIT_INTERVAL seconds and EDIT_MIN_CHARS new
+    characters, which keeps a chat well inside Telegram's flood limits. Replies longer
+    than one Telegram message can't be shown this way; finish() then returns False and
+    the caller falls back to sending the reply in parts.
+    """
+
+    def __init__(self, bot, chat_id, format_text, format_partial_text):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.format_text = format_text
+        self.format_partial_text = format_partial_text
+        self.message = None
+        self.shown_text = ''
+        self.shown_at = 0
+        self.overflowed = False
+
+    async def start(self):
+        """Send the placeholder message."""
+        self.message = await self.bot.send_message(chat_id=self.chat_id, text=PLACEHOLDER)
+        self.shown_at = time.monotonic()
+
+    async def update(self, text):
+        """Show the partial reply, unless the last edit was too recent or too small."""
+        if self.overflowed or self.message is None:
+            return
+        if len(text) > MessageLimit.MAX_TEXT_LENGTH:
+            self.overflowed = True
+            return
+        if time.monotonic() - self.shown_at < EDIT_INTERVAL:
+            return
+        if len(text) - len(self.shown_text) < EDIT_MIN_CHARS:
+            return
+        formatted = self.format_partial_text(text)
+        if formatted.strip():
+            await self.edit(formatted, text)
+
+    async def finish(self, text):
+        """Show the complete reply. Returns False if it doesn't fit into one message."""
+        if self.overflowed or len(text) > MessageLimit.MAX_TEXT_LENGTH:
+            return False
+        await self.edit(self.format_text(text), text, final=True)
+        return True
+
+    async def discard(self):
+        """Delete the placeholder, e.g. before sending the reply in parts instead."""
+        try:
+            await self.message.delete()
+        except TelegramError as e:
+            logging.error(f"Failed to delete progressive message in chat {self.chat_id}: {e}")
+
+    async def edit(self, formatted, text, final=False):
+        if text == self.shown_text:
+            return
+        try:
+            await self.bot.edit_message_text(
+                formatted, chat_id=self.chat_id, message_id=self.message.message_id, parse_mode='HTML',
+                # Partial edits are skipped rather than retried by the rate limiter (see below)
+                rate_limit_args=None if final else {"max_retries": 0}
+            )
+        except BadRequest as e:
+            # The partial text may already have rendered exactly like the final one
+            if 'not modified' not in str(e):
+                raise
+        except RetryAfter as e:
+            metrics.incr('progressive_edit_flood_waits')
+            if final:
+                # The rate limiter has already waited out flood control as often as it will
+                raise
+            # Skip this edit; a later one (at the latest the final one) catches up
+            self.shown_at = time.monotonic() + e.retry_after
+            return
+        self.shown_text = text
+        self.shown_at = time.monotonic()
+        metrics.incr('progressive_edits')
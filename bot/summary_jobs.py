@@ -0,0 +1,78 @@
+"""Conversation summarization off the request path.
+
+handle_message enqueues a job once a chat has more messages than an archive batch and
+the Lambda handler drains the queue after the update (and its reply) has been processed.
+Jobs are recorded in the summary_jobs collection as well as the in-process queue, so a
+job whose container froze or died before draining is picked up by the next invocation
+of any container. Both levels are deduplicated per chat.
+"""
+import asyncio
+import logging
+import time
+import db
+import metrics
+
+
+# Jobs picked up from Mongo per recovery, and how often a container looks for them
+RECOVER_LIMIT = 5
+RECOVER_INTERVAL = 60
+
+queue = asyncio.Queue()
+queued_chats = set()
+last_recovered_at = None
+
+
+async def enqueue(chat_id, message_count=None):
+    """Schedule a summarization of the chat if it has more than one archive batch of messages."""
+    if message_count is not None and message_count <= db.ARCHIVE_BATCH_SIZE:
+        return
+    if chat_id in queued_chats:
+        metrics.incr('summary_jobs_deduplicated')
+        return
+
+    await db.enqueue_summary_job(chat_id)
+    queued_chats.add(chat_id)
+    queue.put_nowait(chat_id)
+    metrics.incr('summary_jobs_enqueued')
+
+
+async def recover():
+    """Queue jobs left behind by frozen or crashed containers, at most once per RECOVER_INTERVAL."""
+    global last_recovered_at
+    if last_recovered_at is not None and time.monotonic() - last_recovered_at < RECOVER_INTERVAL:
+        return
+    last_recovered_at = time.monotonic()
+
+    for chat_id in await db.find_summary_jobs(RECOVER_LIMIT):
+        if chat_id not in queued_chats:
+            queued_chats.add(chat_id)
+            queue.put_nowait(chat_id)
+            metrics.incr('summary_jobs_recovered')
+
+
+async def run_job(chat_id):
+    """Summarize one chat if no other container holds its job."""
+    if not await db.claim_summary_job(chat_id):
+        metrics.incr('summary_jobs_skipped')
+        return
+
+    start = time.monotonic()
+    try:
+        await db.summarize_and_archive_messages(chat_id)
+    finally:
+        # A failed summarization is retried by the next message that crosses the threshold
+        await db.complete_summary_job(chat_id)
+        metrics.observe('summary_job_seconds', time.monotonic() - start)
+
+
+async def drain():
+    """Run every queued job. Called after the update has been processed."""
+    while not queue.empty():
+        chat_id = queue.get_nowait()
+        queued_chats.discard(chat_id)
+        try:
+            await run_job(chat_id)
+        except Exception as exc:
+            logging.error(f"Summary job failed for chat_id: {chat_id}: {exc}", exc_info=True)
+        finally:
+            queue.task_done()
@@ -0,0 +1,216 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+from telegram import User
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest, RequestData
+# Not exported, but it is how the Bot itself serializes parameters
+from telegram.request._requestparameter import RequestParameter
+import db
+import deadline
+import metrics
+
+
+# Where to look for a cached getMe snapshot: 'env', 'file', 'mongo' or empty to always call getMe
+IDENTITY_SOURCE = os.getenv('TELEGRAM_BOT_IDENTITY_SOURCE', '').lower()
+IDENTITY_ENV_VAR = 'TELEGRAM_BOT_IDENTITY'
+IDENTITY_FILE = os.getenv('TELEGRAM_BOT_IDENTITY_FILE', '/tmp/telegram_bot_identity.json')
+
+# Bot API methods that can be answered in the webhook response. Their result is faked, so
+# only methods whose callers don't need the real result belong here.
+WEBHOOK_REPLY_METHODS = {'sendMessage'}
+
+# The WebhookReply of the update being processed, if replying in the webhook response is enabled
+webhook_reply = contextvars.ContextVar('webhook_reply', default=None)
+
+
+async def load_identity(bot_id, source=IDENTITY_SOURCE):
+    """Load a cached getMe snapshot for the bot from the configured source."""
+    try:
+        if source == 'env':
+            raw = os.getenv(IDENTITY_ENV_VAR)
+            identity = json.loads(raw) if raw else None
+        elif source == 'file':
+            if not os.path.exists(IDENTITY_FILE):
+                return None
+            with open(IDENTITY_FILE) as f:
+                identity = json.load(f)
+        elif source == 'mongo':
+            identity = await db.get_bot_identity(bot_id)
+        else:
+            return None
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not load cached bot identity from {source}: {e}")
+        return None
+
+    # A snapshot of a different bot (e.g. after rotating to a new bot) is useless
+    if not identity or identity.get('id') != bot_id:
+        return None
+    return identity
+
+
+async def store_identity(bot_id, identity, source=IDENTITY_SOURCE):
+    """Persist a fresh getMe snapshot to the configured source."""
+    try:
+        if source == 'env':
+            # Environment variables can't be written from inside the function
+            logging.info(f"Set {IDENTITY_ENV_VAR}={json.dumps(identity)} to skip getMe on cold start")
+        elif source == 'file':
+            with open(IDENTITY_FILE, 'w') as f:
+                json.dump(identity, f)
+        elif source == 'mongo':
+            await db.save_bot_identity(bot_id, identity)
+    except OSError as e:
+        logging.error(f"Could not store bot identity to {source}: {e}")
+
+
+class WebhookReply:
+    """Holds the first Bot API call of an update so it can go out in the webhook response.
+
+    Telegram executes one method call returned as the webhook's response body, which
+    saves a request for updates answered with a single message. Only a first call in
+    WEBHOOK_REPLY_METHODS is held back; any later call first sends the held one for real,
+    so messages never arrive out of order.
+    """
+
+    def __init__(self):
+        self.endpoint = None
+        self.data = None
+        self.parameters = None
+        self.closed = False
+        # Calls of the update pass one at a time, so a held call is always sent first
+        self.lock = asyncio.Lock()
+
+    def capture(self, endpoint, data):
+        """Hold the call if it's the update's first and can be answered in the response."""
+        if self.closed or endpoint not in WEBHOOK_REPLY_METHODS:
+            self.closed = True
+            return False
+        request_data = RequestData([RequestParameter.from_input(key, value) for key, value in data.items()])
+        if request_data.contains_files:
+            self.closed = True
+            return False
+        self.endpoint = endpoint
+        self.data = data
+        self.parameters = request_data.json_parameters
+        self.closed = True
+        return True
+
+    def release(self):
+        """Give up the held call (e.g. to send it right away) and return (endpoint, data)."""
+        held = self.endpoint, self.data
+        self.endpoint = self.data = None
+        return held
+
+    def response(self):
+        """The webhook response body carrying the held call, or None if there is none."""
+        if self.endpoint is None:
+            return None
+        return json.dumps(dict(self.parameters, method=self.endpoint))
+
+
+def placeholder_message(data):
+    """A stand-in for the Message Telegram will create from a held sendMessage; its id is unknown."""
+    chat_id = data.get('chat_id')
+    return {
+        "message_id": 0,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "group"},
+        "text": data.get('text')
+    }
+
+
+class CofounderBot(ExtBot):
+    """ExtBot that can seed its identity from a cached snapshot instead of calling getMe on startup.
+
+    The cached identity is validated with a real getMe in the background once the bot is
+    initialized, so the first update doesn't wait for the extra round trip to Telegram.
+    Every request's read timeout is capped to the time left in the invocation, and while
+    a WebhookReply is active the first message of the update is held for the webhook
+    response instead of being sent.
+    """
+
+    __slots__ = ("_identity_source", "_validation_task")
+
+    def __init__(self, *args, identity_source=IDENTITY_SOURCE, **kwargs):
+        self._identity_source = identity_source
+        self._validation_task = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def bot_id(self):
+        # The numeric part of the token is the bot's user id
+        return int(self.token.split(':')[0])
+
+    async def initialize(self):
+        if self._initialized:
+            return
+
+        identity = await load_identity(self.bot_id, self._identity_source) if self._identity_source else None
+        if identity is None:
+            metrics.incr('bot_identity_cache_misses')
+            await super().initialize()
+            if self._identity_source:
+                await store_identity(self.bot_id, self.bot.to_dict(), self._identity_source)
+            return
+
+        metrics.incr('bot_identity_cache_hits')
+        await asyncio.gather(self._request[0].initialize(), self._request[1].initialize())
+        # What ExtBot.initialize would do besides getMe
+        if self.rate_limiter:
+            await self.rate_limiter.initialize()
+        self._bot_user = User.de_json(identity, self)
+        self._initialized = True
+        self._validation_task = asyncio.create_task(self._validate_identity(identity))
+
+    async def _validate_identity(self, cached):
+        """Call getMe and refresh the cached snapshot if it went stale."""
+        try:
+            user = await self.get_me()
+        except Exception as e:
+            logging.error(f"Background bot identity validation failed: {e}")
+            return
+
+        fresh = user.to_dict()
+        if fresh != cached:
+            logging.info("Cached bot identity was stale, refreshing it")
+            await store_identity(self.bot_id, fresh, self._identity_source)
+
+    async def flush_webhook_reply(self):
+        """Send a message held for the webhook response right away, e.g. before a pause."""
+        reply = webhook_reply.get()
+        if reply is None:
+            return
+        async with reply.lock:
+            reply.closed = True
+            if reply.endpoint is not None:
+                held_endpoint, held_data = reply.release()
+                await self._post_bounded(held_endpoint, held_data)
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        reply = webhook_reply.get()
+        if reply is None:
+            return await self._post_bounded(endpoint, data, **kwargs)
+
+        async with reply.lock:
+            # Rate limiter arguments travel inside data; they mean nothing to Telegram
+            parameters = dict(data)
+            self._extract_rl_kwargs(parameters)
+            if reply.capture(endpoint, parameters):
+                metrics.incr('webhook_replies')
+                return placeholder_message(data)
+            if reply.endpoint is not None:
+                held_endpoint, held_data = reply.release()
+                await self._post_bounded(held_endpoint, held_data)
+            return await self._post_bounded(endpoint, data, **kwargs)
+
+    async def _post_bounded(self, endpoint, data, *, read_timeout=BaseRequest.DEFAULT_NONE, **kwargs):
+        if deadline.remaining() is not None:
+            request = self._request[0] if endpoint == "getUpdates" else self._request[1]
+            if read_timeout is BaseRequest.DEFAULT_NONE:
+                read_timeout = request.read_timeout
+            read_timeout = deadline.bound(read_timeout)
+        return await super()._do_post(endpoint, data, read_timeout=read_timeout, **kwargs)
@@ -0,0 +1,151 @@
+"""Checks that the history reads project their documents within the transfer budgets.
+
+The fake collection applies each operation's projection before reporting the reply to
+the listener, so dropping a projection (or its $slice) makes these tests fail.
+
+Run with `python -m pytest` from the bot directory; no MongoDB is needed.
+"""
+import asyncio
+import copy
+import inspect
+from types import SimpleNamespace
+import pytest
+from pymongo import ReturnDocument
+import db
+import mongo_transfer
+from mongo_transfer import TransferBudgetExceeded, TransferListener, track
+
+
+# Erase snapshots of the old embedded layout, heavy enough to exceed every history budget
+ERASED_SNAPSHOTS = 10
+
+
+def message(index):
+    return {"role": "user", "content": "x" * 500, "timestamp": "2024-01-01T00:00:00+00:00", "message_id": index}
+
+
+def conversation_with_erased_history():
+    messages = [message(index) for index in range(db.HISTORY_WINDOW)]
+    return {
+        "chat_id": 1,
+        "messages": messages,
+        "archived_messages": ["summary"],
+        "bucket_seq": 0,
+        "version": 0,
+        "erased_messages": [{"archived_at": "2024-01-01", "messages": messages}] * ERASED_SNAPSHOTS
+    }
+
+
+def project(document, projection):
+    """Apply the projection operators db.py uses to a document."""
+    if projection is None:
+        return copy.deepcopy(document)
+    result = {}
+    for field, spec in projection.items():
+        if field == '_id':
+            continue
+        if spec == 1:
+            if field in document:
+                result[field] = copy.deepcopy(document[field])
+        elif isinstance(spec, dict) and '$slice' in spec:
+            values = document.get(field, [])
+            if isinstance(spec['$slice'], int):
+                result[field] = copy.deepcopy(values[spec['$slice']:])
+            else:
+                skip, limit = spec['$slice']
+                result[field] = copy.deepcopy(values[skip:skip + limit])
+        elif isinstance(spec, dict) and '$size' in spec:
+            result[field] = len(document.get('messages', []))
+        else:
+            raise NotImplementedError(f"Projection of {field}: {spec}")
+    return result
+
+
+def reply(document):
+    """Report a command reply carrying the document to the transfer listener."""
+    TransferListener().succeeded(SimpleNamespace(reply={"value": document, "ok": 1}))
+    return document
+
+
+class FakeConversations:
+    """A single conversation document that find_one and find_one_and_update project."""
+
+    def __init__(self, document, apply_projection=True):
+        self.document = document
+        self.apply_projection = apply_projection
+
+    def project(self, document, projection):
+        return project(document, projection if self.apply_projection else None)
+
+    async def find_one(self, query, projection=None):
+        return reply(self.project(self.document, projection))
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=ReturnDocument.BEFORE):
+        before = self.project(self.document, projection)
+        for field, value in update.get('$push', {}).items():
+            self.document.setdefault(field, []).append(value)
+        for field, value in update.get('$set', {}).items():
+            self.document[field] = value
+        return reply(before if return_document == ReturnDocument.BEFORE else self.project(self.document, projection))
+
+
+class FakeWrites:
+    """Collections that are only written to; their replies are tiny."""
+
+    async def insert_one(self, document):
+        return reply(None)
+
+    async def update_many(self, query, update):
+        return reply(None)
+
+
+async def summarize(*args, **kwargs):
+    return "summary"
+
+
+async def archive_batch(*args, **kwargs):
+    return True
+
+
+# Every tracked read that returns (part of) a conversation document, with how it's called
+HISTORY_READS = {
+    "get_conversation_history": lambda function: function(1),
+    "append_and_get_history": lambda function: function(1, 'user', "new", 10 ** 6),
+    "summarize_and_archive_messages": lambda function: function(1),
+    "erase_history": lambda function: function(1),
+}
+
+
+@pytest.fixture
+def strict(monkeypatch):
+    monkeypatch.setattr(mongo_transfer, 'ENABLED', True)
+    monkeypatch.setattr(mongo_transfer, 'STRICT', True)
+    monkeypatch.setattr(db, 'erased_conversations', FakeWrites())
+    monkeypatch.setattr(db, 'message_buckets', FakeWrites())
+    monkeypatch.setattr(db, 'summarize', summarize)
+    monkeypatch.setattr(db, 'archive_batch', archive_batch)
+
+
+def run_read(monkeypatch, operation, conversations):
+    monkeypatch.setattr(db, 'conversations', conversations)
+    # Tracked here since db.py is usually imported with the listener disabled
+    tracked = track(operation)(inspect.unwrap(getattr(db, operation)))
+    return asyncio.run(HISTORY_READS[operation](tracked))
+
+
+@pytest.mark.parametrize("operation", HISTORY_READS)
+def test_history_read_leaves_erased_history_behind(strict, monkeypatch, operation):
+    run_read(monkeypatch, operation, FakeConversations(conversation_with_erased_history()))
+
+
+@pytest.mark.parametrize("operation", HISTORY_READS)
+def test_unprojected_history_read_exceeds_budget(strict, monkeypatch, operation):
+    with pytest.raises(TransferBudgetExceeded):
+        run_read(monkeypatch, operation, FakeConversations(conversation_with_erased_history(), apply_projection=False))
+
+
+def test_history_read_returns_the_window(strict, monkeypatch):
+    document = conversation_with_erased_history()
+    document['messages'] = [message(index) for index in range(3 * db.HISTORY_WINDOW)]
+    history = run_read(monkeypatch, "get_conversation_history", FakeConversations(document))
+    assert len(history) == db.HISTORY_WINDOW + 1
@@ -0,0 +1,63 @@
+"""Process every Telegram update at most once, keyed on its update_id.
+
+Telegram redelivers an update whenever the webhook call fails or times out, and main()
+would otherwise run the whole handler (OpenAI call, stored messages, reply) again. Each
+update is claimed before any work is done: a warm container remembers the update_ids it
+has seen in an LRU, and the processed_updates collection (expired by a TTL index) covers
+redeliveries that land on another container. An update that fails is released again so
+that the redelivery can retry it. Disable with COFOUNDERAI_UPDATE_DEDUP=0.
+"""
+import os
+from collections import OrderedDict
+import db
+import metrics
+
+
+ENABLED = os.getenv('COFOUNDERAI_UPDATE_DEDUP', '1') != '0'
+MAX_ENTRIES = 1024
+
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+
+# update_id -> IN_FLIGHT or DONE; most recently seen last
+states = OrderedDict()
+
+
+async def claim(update_id):
+    """Start processing the update. Returns False if it's processed or in flight already."""
+    if not ENABLED:
+        return True
+    state = states.get(update_id)
+    if state is not None:
+        metrics.incr(f'duplicate_updates_{state}')
+        return False
+    # Claimed in memory first, so a concurrent duplicate in this container stops here
+    remember(update_id, IN_FLIGHT)
+    if not await db.claim_processed_update(update_id):
+        metrics.incr('duplicate_updates_mongo')
+        states.pop(update_id, None)
+        return False
+    return True
+
+
+async def finish(update_id):
+    """Record that the update was processed."""
+    if not ENABLED:
+        return
+    remember(update_id, DONE)
+    await db.finish_processed_update(update_id)
+
+
+async def release(update_id):
+    """Forget an update whose processing failed, so that it's processed again when redelivered."""
+    if not ENABLED:
+        return
+    states.pop(update_id, None)
+    await db.release_processed_update(update_id)
+
+
+def remember(update_id, state):
+    states[update_id] = state
+    states.move_to_end(update_id)
+    while len(states) > MAX_ENTRIES:
+        states.popitem(last=False)
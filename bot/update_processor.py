@@ -0,0 +1,102 @@
+"""Concurrent update processing across chats, one update at a time within a chat.
+
+Two updates of the same chat must not run at once: they would interleave saving
+messages with reading the history and race the archiver. ChatSerialUpdateProcessor
+runs the updates of different chats concurrently (up to max_concurrent_updates) but
+queues the updates of a chat behind each other, in the order they arrived. Within a
+container a per-chat lock does this; across containers each update also takes the
+chat's lease in the chat_leases collection (COFOUNDERAI_CHAT_LEASE=0 turns that off).
+A lease is held until the update's invocation ends at the latest, and if it can't be
+taken within CHAT_LEASE_WAIT seconds the update is processed anyway rather than lost.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import timedelta
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from chat_locks import ChatLocks
+import db
+import deadline
+import metrics
+
+
+MAX_CONCURRENT_UPDATES = int(os.getenv('COFOUNDERAI_MAX_CONCURRENT_UPDATES', 8))
+# Updates admitted at once, including those waiting for their chat's turn
+MAX_PENDING_UPDATES = 4 * MAX_CONCURRENT_UPDATES
+
+LEASES_ENABLED = os.getenv('COFOUNDERAI_CHAT_LEASE', '1') != '0'
+# Lease duration when the invocation has no deadline, and how long to wait for another container's lease
+CHAT_LEASE = timedelta(minutes=2)
+CHAT_LEASE_WAIT = float(os.getenv('COFOUNDERAI_CHAT_LEASE_WAIT', 30))
+LEASE_POLL_INTERVAL = 0.25
+MAX_LEASE_POLL_INTERVAL = 2.0
+
+
+def chat_id_of(update):
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class ChatSerialUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different chats concurrently and those of one chat in order."""
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, max_pending_updates=MAX_PENDING_UPDATES):
+        # The base class takes its semaphore before do_process_update, i.e. before the chat's
+        # turn has come, so it only bounds the admitted updates; the concurrency limit is
+        # applied once an update may actually run
+        super().__init__(max_pending_updates)
+        # max_concurrent_updates reports the admission limit, so callers that need the
+        # number of updates that actually run at once use max_running_updates
+        self.max_running_updates = max_concurrent_updates
+        self.running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.chat_locks = ChatLocks()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = chat_id_of(update)
+        start = time.monotonic()
+        if chat_id is None:
+            async with self.running:
+                metrics.observe('update_wait_seconds', time.monotonic() - start)
+                await coroutine
+            return
+
+        async with self.chat_locks.get(chat_id):
+            metrics.observe('chat_lock_wait_seconds', time.monotonic() - start)
+            owner = await self.acquire_lease(chat_id) if LEASES_ENABLED else None
+            try:
+                async with self.running:
+                    metrics.observe('update_wait_seconds', time.monotonic() - start)
+                    await coroutine
+            finally:
+                if owner is not None:
+                    await db.release_chat_lease(chat_id, owner)
+
+    async def acquire_lease(self, chat_id):
+        """Wait for the chat's lease in Mongo. Returns the owner id to release it with, or None."""
+        owner = uuid.uuid4().hex
+        remaining = deadline.remaining()
+        # Held until the invocation is killed at the latest, so a frozen or dead container can't block the chat
+        duration = timedelta(seconds=max(remaining, 0) + deadline.SAFETY_MARGIN) if remaining is not None else CHAT_LEASE
+        start = time.monotonic()
+        interval = LEASE_POLL_INTERVAL
+        while not await db.acquire_chat_lease(chat_id, owner, duration):
+            waited = time.monotonic() - start
+            left = deadline.remaining()
+            if waited >= CHAT_LEASE_WAIT or (left is not None and left <= interval):
+                metrics.incr('chat_lease_timeouts')
+                logging.warning(f"Chat {chat_id} is still leased by another container after {waited:.1f}s, processing anyway")
+                return None
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, MAX_LEASE_POLL_INTERVAL)
+        metrics.observe('chat_lease_wait_seconds', time.monotonic() - start)
+        return owner
@@ -0,0 +1,144 @@
+"""Ingest mode: acknowledge webhooks right away and process the updates in a worker.
+
+With COFOUNDERAI_INGEST_MODE set, lambda_handler only validates the update, queues it
+and answers Telegram with 200, so the webhook's latency no longer depends on OpenAI
+and a slow completion can't make Telegram redeliver the update. worker_handler (a
+separate Lambda entry point, e.g. invoked on a schedule or asynchronously after each
+ingest) drains the queue through application.process_update.
+
+'mongo' queues in the update_queue collection, where the unique update_id also drops
+redeliveries, and is what a deployment uses. 'local' is an in-process stand-in for
+development: nothing runs between invocations, so ingest drains it before answering.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import db
+import deadline
+import metrics
+
+
+INGEST_MODE = os.getenv('COFOUNDERAI_INGEST_MODE', '').lower()
+# The secret_token given to setWebhook; Telegram sends it back with every update
+WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+# Time kept before the deadline for putting back the updates that didn't finish
+REQUEUE_RESERVE = 1.0
+
+local_queue = asyncio.Queue()
+
+
+class InvalidUpdate(ValueError):
+    pass
+
+
+def validate(event):
+    """Return the update carried by a webhook event, or raise InvalidUpdate."""
+    if WEBHOOK_SECRET:
+        headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ''), WEBHOOK_SECRET):
+            raise InvalidUpdate("wrong or missing secret token")
+    try:
+        update = json.loads(event['body'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidUpdate(f"body is not JSON: {e}")
+    if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+        raise InvalidUpdate("body has no update_id")
+    return update
+
+
+async def enqueue(update):
+    """Queue an update for the worker. Returns False if it was already queued."""
+    if INGEST_MODE == 'local':
+        local_queue.put_nowait({"update_id": update['update_id'], "update": update, "attempts": 1})
+        queued = True
+    else:
+        queued = await db.enqueue_update(update['update_id'], update)
+    metrics.incr('updates_queued' if queued else 'updates_requeued')
+    return queued
+
+
+async def claim():
+    """Take the next update to process, or None if the queue is empty."""
+    if INGEST_MODE == 'local':
+        return None if local_queue.empty() else local_queue.get_nowait()
+    return await db.claim_update()
+
+
+async def complete(entry):
+    if INGEST_MODE != 'local':
+        await db.complete_update(entry['update_id'])
+
+
+async def fail(entry):
+    if INGEST_MODE == 'local':
+        if entry['attempts'] < db.MAX_UPDATE_ATTEMPTS:
+            local_queue.put_nowait(dict(entry, attempts=entry['attempts'] + 1))
+        return
+    await db.release_update(entry['update_id'], entry['attempts'])
+
+
+async def requeue(entry):
+    if INGEST_MODE == 'local':
+        local_queue.put_nowait(entry)
+        return
+    await db.requeue_update(entry['update_id'])
+
+
+async def run(process, entry):
+    """Process one queued update. Returns True if it succeeded."""
+    try:
+        await process(entry['update'])
+    except asyncio.CancelledError:
+        # Out of time (see drain), so it's left to the next worker without spending an attempt
+        metrics.incr('updates_requeued_unfinished')
+        await requeue(entry)
+        raise
+    except Exception as exc:
+        metrics.incr('updates_failed')
+        logging.error(f"Processing update {entry['update_id']} failed (attempt {entry['attempts']}): {exc}", exc_info=True)
+        await fail(entry)
+        return False
+    await complete(entry)
+    return True
+
+
+def time_left():
+    """Seconds the worker may still wait for running updates, or None without a deadline."""
+    left = deadline.remaining()
+    return None if left is None else max(left - REQUEUE_RESERVE, 0)
+
+
+async def drain(process, has_time, concurrency=1):
+    """Process queued updates with process(update), up to concurrency at once, while has_time() allows.
+
+    Updates are claimed oldest first and started in that order, and only as many are
+    claimed as can run. Updates still running when the deadline comes are cancelled and
+    put back. Returns how many succeeded.
+    """
+    running = set()
+    processed = 0
+    while has_time():
+        if len(running) >= concurrency:
+            done, running = await asyncio.wait(running, timeout=time_left(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            processed += sum(task.result() for task in done)
+            continue
+        entry = await claim()
+        if entry is None:
+            break
+        running.add(asyncio.ensure_future(run(process, entry)))
+    if running:
+        done, running = await asyncio.wait(running, timeout=time_left())
+        processed += sum(task.result() for task in done)
+    if running:
+        logging.warning(f"Out of time with {len(running)} updates still running, putting them back")
+        for task in running:
+            task.cancel()
+        await asyncio.wait(running)
+    metrics.incr('updates_processed', processed)
+    return processed